@@ -1,11 +1,17 @@
 import os
 import sys
-import json
-import traceback
+import logging
+import shutil
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from dotenv import load_dotenv
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Загружаем .env
 load_dotenv()
@@ -14,9 +20,16 @@ WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN", "terra_bot_verify_token_2024")
 SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
 SERVER_PORT = int(os.getenv("SERVER_PORT", "8000"))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+logging.basicConfig(
+    level=LOG_LEVEL,
+    format="%(asctime)s %(levelname)s [%(threadName)s] %(message)s",
+)
+logger = logging.getLogger("terra")
 
 if not WHATSAPP_TOKEN:
-    print("❌ ERROR: WHATSAPP_TOKEN is not set in .env")
+    logger.error("❌ ERROR: WHATSAPP_TOKEN is not set in .env")
     sys.exit(1)
 
 # v2 API
@@ -27,89 +40,200 @@ HEADERS = {
     "Content-Type": "application/json"
 }
 
-app = Flask(__name__)
+# (connect, read) таймауты исходящих запросов, сек
+TIMEOUT = (3.05, 10)
 
+# Одна сессия на процесс: соединение с 360dialog (TCP + TLS)
+# переиспользуется, а не открывается заново на каждое сообщение
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+# Ошибки соединения повторяются с backoff. POST по статусу ответа
+# не повторяется: 360dialog мог уже принять сообщение, будет дубль
+RETRY = Retry(total=3, backoff_factor=0.2, status_forcelist=(502, 503, 504))
+SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=50, max_retries=RETRY))
 
-def log_request(label: str, data):
-    """Красиво логируем входящие/исходящие данные"""
-    print(f"\n=== {label} ===")
-    try:
-        print(json.dumps(data, indent=4, ensure_ascii=False))
-    except Exception:
-        print(str(data))
-    print("=== END ===\n")
+# Фоновая обработка сообщений: webhook не ждёт исходящих запросов к 360dialog
+# Число одновременно обрабатываемых сообщений ограничено размером пула
+MESSAGE_CONCURRENCY = int(os.getenv("MESSAGE_CONCURRENCY", "16"))
+EXECUTOR = ThreadPoolExecutor(max_workers=MESSAGE_CONCURRENCY, thread_name_prefix="terra")
 
 
-def send_text_message(to: str, text: str):
-    """Отправка обычного текстового сообщения через 360dialog v2"""
-    payload = {
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON-провайдер Flask на orjson: jsonify() без stdlib json"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+
+def log_request(label: str, data):
+    """Логируем входящие/исходящие данные (только при LOG_LEVEL=DEBUG)"""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    if isinstance(data, bytes):
+        text = data.decode("utf-8", "replace")
+    else:
+        try:
+            text = orjson.dumps(data).decode("utf-8")
+        except TypeError:
+            text = str(data)
+    logger.debug("%s %s", label, text)
+
+
+def log_response(label: str, resp):
+    """Логируем ответ 360dialog: тело декодируем только при ошибке или в DEBUG"""
+    if resp.status_code >= 400:
+        logger.error("%s: %s %s", label, resp.status_code, resp.text)
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s: %s %s", label, resp.status_code, resp.text)
+
+
+@lru_cache(maxsize=256)
+def _text_tail(text: str) -> bytes:
+    """JSON текстового сообщения без "to" и открывающей скобки.
+
+    Бот отвечает небольшим набором фиксированных фраз, поэтому
+    сериализованная часть кэшируется по тексту.
+    """
+    return orjson.dumps({
         "recipient_type": "individual",
-        "to": to,
         "type": "text",
         "text": {
             "body": text,
             "preview_url": False
         }
-    }
+    })[1:]
 
-    log_request("SEND TEXT PAYLOAD", payload)
-    resp = requests.post(API_URL, headers=HEADERS, json=payload)
-    try:
-        body = resp.json()
-    except Exception:
-        body = resp.text
 
-    print(f"SEND TEXT RESPONSE: {resp.status_code} {body}")
+def send_text_message(to: str, text: str):
+    """Отправка обычного текстового сообщения через 360dialog v2"""
+    data = b'{"to":' + orjson.dumps(to) + b"," + _text_tail(text)
+
+    log_request("SEND TEXT PAYLOAD", data)
+    resp = SESSION.post(API_URL, data=data, timeout=TIMEOUT)
+    log_response("SEND TEXT RESPONSE", resp)
     return resp
 
 
-def send_menu_buttons(to: str):
-    """Отправка меню с кнопками BTN_START и BTN_MENU"""
-    payload = {
-        "to": to,
-        "type": "interactive",
-        "recipient_type": "individual",
-        "interactive": {
-            "type": "button",
-            "body": {
-                "text": "Выберите действие:"
-            },
-            "action": {
-                "buttons": [
-                    {
-                        "type": "reply",
-                        "reply": {
-                            "id": "BTN_START",
-                            "title": "Старт"
-                        }
-                    },
-                    {
-                        "type": "reply",
-                        "reply": {
-                            "id": "BTN_MENU",
-                            "title": "Меню"
-                        }
+# Меню одинаковое для всех пользователей, меняется только "to":
+# сериализуем его один раз при импорте
+MENU_PAYLOAD = {
+    "type": "interactive",
+    "recipient_type": "individual",
+    "interactive": {
+        "type": "button",
+        "body": {
+            "text": "Выберите действие:"
+        },
+        "action": {
+            "buttons": [
+                {
+                    "type": "reply",
+                    "reply": {
+                        "id": "BTN_START",
+                        "title": "Старт"
                     }
-                ]
-            }
+                },
+                {
+                    "type": "reply",
+                    "reply": {
+                        "id": "BTN_MENU",
+                        "title": "Меню"
+                    }
+                }
+            ]
         }
     }
+}
 
-    log_request("SEND MENU PAYLOAD", payload)
-    resp = requests.post(API_URL, headers=HEADERS, json=payload)
-    try:
-        body = resp.json()
-    except Exception:
-        body = resp.text
+MENU_TEXT = MENU_PAYLOAD["interactive"]["body"]["text"]
+
+# Приветствия, которые отправляются вместе с меню одним сообщением
+GREETING_START = "Привет! Это Terra Bot 🌱"
+GREETING_LAUNCH = "🚀 Запуск! Бот готов работать."
+
+
+def _build_menu_tail(greeting: str = None) -> bytes:
+    """JSON меню без открывающей скобки: '"type":...,"interactive":{...}}'"""
+    if not greeting:
+        return orjson.dumps(MENU_PAYLOAD)[1:]
+    interactive = {
+        **MENU_PAYLOAD["interactive"],
+        "body": {"text": f"{greeting}\n\n{MENU_TEXT}"},
+    }
+    return orjson.dumps({**MENU_PAYLOAD, "interactive": interactive})[1:]
+
+
+_MENU_TAILS = {
+    None: _build_menu_tail(),
+    GREETING_START: _build_menu_tail(GREETING_START),
+    GREETING_LAUNCH: _build_menu_tail(GREETING_LAUNCH),
+}
 
-    print(f"SEND BUTTONS RESPONSE: {resp.status_code} {body}")
+
+def send_menu_buttons(to: str, greeting: str = None):
+    """Отправка меню с кнопками BTN_START и BTN_MENU (с приветствием в тексте)"""
+    tail = _MENU_TAILS.get(greeting) or _build_menu_tail(greeting)
+    data = b'{"to":' + orjson.dumps(to) + b"," + tail
+
+    log_request("SEND MENU PAYLOAD", data)
+    resp = SESSION.post(API_URL, data=data, timeout=TIMEOUT)
+    log_response("SEND BUTTONS RESPONSE", resp)
     return resp
 
 
+@lru_cache(maxsize=1024)
 def normalize_text(text: str) -> str:
+    # Пользователи пишут одни и те же команды - результат кэшируется
     return (text or "").strip().lower()
 
 
+def _cmd_start(wa_id: str):
+    # Приветствие в тексте меню: один запрос к 360dialog вместо двух
+    send_menu_buttons(wa_id, GREETING_START)
+
+
+def _cmd_menu(wa_id: str):
+    send_menu_buttons(wa_id)
+
+
+def _cmd_default(wa_id: str):
+    # Можно просто ничего не отвечать или отправлять дефолт
+    send_text_message(
+        wa_id,
+        "Я тебя понял, но пока реагирую только на команды: start / меню."
+    )
+
+
+def _btn_start(wa_id: str):
+    send_menu_buttons(wa_id, GREETING_LAUNCH)
+
+
+def _btn_ignore(wa_id: str):
+    pass
+
+
+# Таблицы команд: нормализованный текст / ID кнопки → обработчик
+TEXT_HANDLERS = {
+    "start": _cmd_start,
+    "/start": _cmd_start,
+    "старт": _cmd_start,
+    "menu": _cmd_menu,
+    "меню": _cmd_menu,
+}
+
+BUTTON_HANDLERS = {
+    "BTN_START": _btn_start,
+    "BTN_MENU": _cmd_menu,
+}
+
+
 @app.route("/webhook", methods=["GET"])
 def verify_webhook():
     """Верификация webhook 360dialog (GET)"""
@@ -117,41 +241,24 @@ def verify_webhook():
     token = request.args.get("hub.verify_token")
     challenge = request.args.get("hub.challenge")
 
-    print(f"Webhook VERIFY: mode={mode}, token={token}, challenge={challenge}")
+    logger.info("Webhook VERIFY: mode=%s, token=%s", mode, "***" if token else None)
 
     if mode == "subscribe" and token == VERIFY_TOKEN:
         return challenge, 200
     return "Verification token mismatch", 403
 
 
-@app.route("/webhook", methods=["POST"])
-def handle_webhook():
-    """Основной обработчик входящих сообщений WhatsApp"""
-    data = request.get_json(force=True, silent=True) or {}
-    log_request("INCOMING", data)
-
-    try:
-        # Структура 360dialog / Meta:
-        # object -> entry[0] -> changes[0] -> value
-        entry = (data.get("entry") or [])[0]
-        change = (entry.get("changes") or [])[0]
-        value = change.get("value", {})
-
-        messages = value.get("messages", [])
-        contacts = value.get("contacts", [])
+def _extract_wa_id(msg: dict, contacts: list):
+    """Определяем wa_id отправителя сообщения"""
+    wa_id = msg.get("from")
+    if not wa_id and contacts:
+        wa_id = contacts[0].get("wa_id")
+    return wa_id
 
-        if not messages:
-            return jsonify({"status": "no messages"}), 200
-
-        msg = messages[0]
-
-        # Определяем wa_id пользователя
-        wa_id = None
-        if contacts:
-            wa_id = contacts[0].get("wa_id")
-        if not wa_id:
-            wa_id = msg.get("from")
 
+def _process_message(msg: dict, wa_id: str):
+    """Обработка одного входящего сообщения (в фоновом потоке)"""
+    try:
         msg_type = msg.get("type")
 
         # --- ТЕКСТОВЫЕ СООБЩЕНИЯ ---
@@ -159,21 +266,9 @@ def handle_webhook():
             text_body = msg.get("text", {}).get("body", "")
             norm = normalize_text(text_body)
 
-            print(f"➡ TEXT from {wa_id}: {text_body} (norm: {norm})")
-
-            if norm in ("start", "/start", "старт"):
-                send_text_message(wa_id, "Привет! Это Terra Bot 🌱")
-                send_menu_buttons(wa_id)
-
-            elif norm in ("menu", "меню"):
-                send_menu_buttons(wa_id)
+            logger.info("➡ TEXT from %s (norm: %s)", wa_id, norm)
 
-            else:
-                # Можно просто ничего не отвечать или отправлять дефолт
-                send_text_message(
-                    wa_id,
-                    "Я тебя понял, но пока реагирую только на команды: start / меню."
-                )
+            TEXT_HANDLERS.get(norm, _cmd_default)(wa_id)
 
         # --- НАЖАТИЯ КНОПОК ---
         elif msg_type == "interactive":
@@ -189,25 +284,71 @@ def handle_webhook():
             elif "button" in interactive and "reply" in interactive["button"]:
                 button_id = interactive["button"]["reply"].get("id")
 
-            print(f"➡ BUTTON from {wa_id}: {button_id}")
+            logger.info("➡ BUTTON from %s: %s", wa_id, button_id)
 
-            if button_id == "BTN_START":
-                send_text_message(wa_id, "🚀 Запуск! Бот готов работать.")
-                send_menu_buttons(wa_id)
-
-            elif button_id == "BTN_MENU":
-                send_menu_buttons(wa_id)
+            BUTTON_HANDLERS.get(button_id, _btn_ignore)(wa_id)
 
         else:
-            print(f"❔ Unsupported message type: {msg_type}")
+            logger.warning("❔ Unsupported message type: %s", msg_type)
+
+    except Exception:
+        logger.exception("❌ ERROR in _process_message")
 
-    except Exception as e:
-        print("❌ ERROR in handle_webhook:", repr(e))
-        traceback.print_exc()
+
+@app.route("/webhook", methods=["POST"])
+def handle_webhook():
+    """Основной обработчик входящих сообщений WhatsApp"""
+    try:
+        # cache=False: тело читается один раз, копию в request не храним
+        data = orjson.loads(request.get_data(cache=False)) or {}
+    except orjson.JSONDecodeError:
+        data = {}
+
+    try:
+        # Структура 360dialog / Meta:
+        # object -> entry[0] -> changes[0] -> value
+        # Прямой доступ без промежуточных пустых списков
+        try:
+            value = data["entry"][0]["changes"][0]["value"]
+        except (KeyError, IndexError, TypeError):
+            return jsonify({"status": "no messages"}), 200
+
+        # Статусы доставки (sent/delivered/read) - основная часть трафика
+        # webhook: подтверждаем сразу, без логирования payload
+        messages = value.get("messages")
+        if not messages:
+            if value.get("statuses"):
+                return jsonify({"status": "ignored"}), 200
+            return jsonify({"status": "no messages"}), 200
+
+        log_request("INCOMING", data)
+
+        contacts = value.get("contacts")
+
+        # Отвечаем 360dialog сразу, отправка ответов идёт в фоне.
+        # В одном webhook может прийти несколько сообщений - обрабатываем все
+        for msg in messages:
+            EXECUTOR.submit(_process_message, msg, _extract_wa_id(msg, contacts))
+
+    except Exception:
+        logger.exception("❌ ERROR in handle_webhook")
 
     return jsonify({"status": "ok"}), 200
 
 
 if __name__ == "__main__":
-    print(f"Starting Terra Bot on {SERVER_HOST}:{SERVER_PORT}")
-    app.run(host=SERVER_HOST, port=SERVER_PORT)
+    logger.info("Starting Terra Bot on %s:%s", SERVER_HOST, SERVER_PORT)
+
+    # gunicorn (gthread) вместо однопоточного dev-сервера Flask.
+    # Настройки - в gunicorn.conf.py (bind, потоки, WEB_WORKERS).
+    # На Windows gunicorn не работает - там остаётся app.run()
+    if os.name != "nt" and shutil.which("gunicorn"):
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        os.chdir(base_dir)
+        os.execvp("gunicorn", [
+            "gunicorn",
+            "-c", os.path.join(base_dir, "gunicorn.conf.py"),
+            "bot:app",
+        ])
+
+    app.run(host=SERVER_HOST, port=SERVER_PORT, threaded=True)
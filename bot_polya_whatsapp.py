@@ -2,21 +2,29 @@
 # -*- coding: utf-8 -*-
 
 import os
+import queue
+import re
 import sqlite3
 import sys
-from contextlib import closing
+import threading
+import time
+from contextlib import closing, contextmanager
 from datetime import datetime, timedelta, date
-from typing import Dict, Optional, Tuple, List, Callable, Any
+from typing import Dict, Optional, Tuple, List, Callable
 from pathlib import Path
-from dataclasses import dataclass
 import calendar
+import functools
 import logging
+from itertools import groupby
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
 
 from pywa import WhatsApp
 from pywa.types import Message as WAMessage, Button
 from pywa.filters import text
 from dotenv import load_dotenv
 from flask import Flask
+from cachetools import TTLCache
 
 # Google Sheets API
 from google.oauth2.credentials import Credentials
@@ -27,6 +35,7 @@ from googleapiclient.errors import HttpError
 
 # Scheduler для автоматического экспорта
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor as SchedulerThreadPool
 from apscheduler.triggers.cron import CronTrigger
 
 # -----------------------------
@@ -66,7 +75,7 @@ def _parse_admin_ids(s: str) -> List[str]:
         out.append(part.strip())
     return out
 
-ADMIN_IDS = set(_parse_admin_ids(os.getenv("ADMIN_IDS", "")))
+ADMIN_IDS = frozenset(_parse_admin_ids(os.getenv("ADMIN_IDS", "")))
 
 DB_PATH = os.path.join(os.getcwd(), "reports_whatsapp.db")
 
@@ -112,34 +121,158 @@ GROUP_WARE = "склад"
 # Хранилище состояний пользователей (в памяти)
 # -----------------------------
 
-user_states: Dict[str, dict] = {}
+# Ограниченный кэш (LRU + TTL): состояния неактивных пользователей удаляются,
+# память не растёт с каждым новым отправителем
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "10000"))
+STATE_TTL_SECONDS = int(os.getenv("STATE_TTL_SECONDS", "3600"))
+
+user_states: "TTLCache[str, dict]" = TTLCache(maxsize=STATE_CACHE_SIZE, ttl=STATE_TTL_SECONDS)
+# TTLCache не потокобезопасен
+_states_lock = threading.Lock()
 
 # TODO: вынести FSM в SQLite (user_state) для надёжности при перезапуске.
 def get_state(user_id: str) -> dict:
-    if user_id not in user_states:
-        user_states[user_id] = {"state": None, "data": {}}
-    return user_states[user_id]
+    with _states_lock:
+        s = user_states.get(user_id)
+        if s is None:
+            s = {"state": None, "data": {}}
+        # Повторная запись продлевает TTL: активный диалог не истекает
+        user_states[user_id] = s
+        return s
 
 # TODO: вынести FSM в SQLite (user_state) для надёжности при перезапуске.
 def set_state(user_id: str, state: Optional[str], data: dict = None):
-    s = get_state(user_id)
-    s["state"] = state
-    if data is not None:
-        s["data"] = data
+    # Чтение, изменение и запись (с продлением TTL) - под одной блокировкой
+    with _states_lock:
+        s = user_states.get(user_id)
+        if s is None:
+            s = {"state": None, "data": {}}
+        s["state"] = state
+        if data is not None:
+            s["data"] = data
+        user_states[user_id] = s
 
 # TODO: вынести FSM в SQLite (user_state) для надёжности при перезапуске.
 def clear_state(user_id: str):
-    user_states[user_id] = {"state": None, "data": {}}
+    with _states_lock:
+        user_states[user_id] = {"state": None, "data": {}}
 
 # -----------------------------
 # БД (те же функции, что в Telegram версии)
 # -----------------------------
 
-def connect():
-    return sqlite3.connect(DB_PATH)
+# Отображение файла БД в память (байты, 0 - выключено): чтения отчётов идут из
+# страниц ОС без копирования в буфер SQLite
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+def _open_connection(isolation_level: str = "", check_same_thread: bool = True) -> sqlite3.Connection:
+    # Скомпилированные запросы кэшируются на соединении (по умолчанию 128):
+    # соединения живут долго, и все запросы файла помещаются в кэш
+    con = sqlite3.connect(
+        DB_PATH,
+        check_same_thread=check_same_thread,
+        isolation_level=isolation_level,
+        cached_statements=256,
+    )
+    # WAL: читатели не блокируют писателя и наоборот;
+    # synchronous=NORMAL в режиме WAL безопасен и вдвое сокращает fsync
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA busy_timeout=5000")
+    con.execute("PRAGMA cache_size=-20000")
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    return con
+
+
+class _Pool:
+    """
+    Пул соединений SQLite: соединения открываются по мере надобности
+    (не больше size) и переиспользуются, а не открываются на каждый запрос.
+    """
+
+    def __init__(self, size: int, isolation_level: str = ""):
+        self._size = max(1, size)
+        self._isolation_level = isolation_level
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _new_connection(self) -> sqlite3.Connection:
+        return _open_connection(self._isolation_level, check_same_thread=False)
+
+    def _get(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self._size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._new_connection()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        # Все соединения заняты - ждём освободившееся
+        return self._idle.get()
+
+    @contextmanager
+    def acquire(self):
+        """
+        Выдаёт соединение из пула. Как и `with sqlite3.connect(...)`:
+        commit при успехе, rollback при исключении.
+        """
+        con = self._get()
+        try:
+            with con:
+                yield con
+        finally:
+            self._idle.put(con)
+
+
+class _ThreadLocalReader:
+    """
+    Соединения только для чтения: у каждого потока своё, открывается один раз.
+    Чтение на каждом шаге диалога обходится без очереди пула.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @contextmanager
+    def acquire(self):
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = _open_connection()
+            # Защита от случайной записи через читающее соединение
+            con.execute("PRAGMA query_only=ON")
+            self._local.con = con
+        yield con
+
+
+# Один писатель (SQLite всё равно пишет по одному), читатели - по соединению на поток.
+# Писатель открывает транзакции как BEGIN IMMEDIATE: блокировка на запись
+# берётся сразу (с ожиданием busy_timeout), а не при первом изменении
+READ_POOL = _ThreadLocalReader()
+WRITE_POOL = _Pool(1, isolation_level="IMMEDIATE")
+
+# Версия схемы reports_daily_agg и её триггеров (PRAGMA user_version)
+AGG_SCHEMA_VERSION = 1
 
 def init_db():
-    with connect() as con, closing(con.cursor()) as c:
+    with WRITE_POOL.acquire() as con, closing(con.cursor()) as c:
+        # Вся инициализация - одной транзакцией с блокировкой на запись сразу:
+        # init_db вызывается в каждом воркере gunicorn, и второй воркер ждёт
+        # первого, а затем видит уже готовую схему (и новую user_version).
+        # Без явного BEGIN модуль sqlite3 открыл бы транзакцию только на первом
+        # INSERT, и DDL/перестройка агрегатов шли бы вне неё
+        c.execute("BEGIN IMMEDIATE")
         c.execute("""
         CREATE TABLE IF NOT EXISTS users(
           user_id    TEXT PRIMARY KEY,
@@ -189,6 +322,12 @@ def init_db():
         )
         """)
         c.execute("""
+        CREATE TABLE IF NOT EXISTS export_cursor(
+          id             INTEGER PRIMARY KEY CHECK (id = 1),
+          last_report_id INTEGER NOT NULL
+        )
+        """)
+        c.execute("""
         CREATE TABLE IF NOT EXISTS monthly_sheets(
           id            INTEGER PRIMARY KEY AUTOINCREMENT,
           year          INTEGER,
@@ -200,6 +339,94 @@ def init_db():
         )
         """)
 
+        # Индексы под горячие запросы к reports: по пользователю+дате,
+        # по дате (статистика за день/период) и по пользователю+времени создания.
+        # google_exports.report_id уже UNIQUE - отдельный индекс не нужен
+        c.execute("CREATE INDEX IF NOT EXISTS idx_reports_user_date ON reports(user_id, work_date)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_reports_workdate ON reports(work_date)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_reports_user_created ON reports(user_id, created_at)")
+
+        # Дневные итоги по (пользователь, дата, место, работа) для статистики:
+        # поддерживаются триггерами на reports, fetch_stats_* читают готовые суммы.
+        # rows_count - сколько отчётов в группе, строка удаляется вместе с последним.
+        # location/activity в ключе хранятся как coalesce(col, ''): NULL не равен
+        # NULL, и такие группы не сливались бы ON CONFLICT и не находились триггерами.
+        # Версия схемы агрегатов - в PRAGMA user_version: при её смене триггеры
+        # пересоздаются, а таблица заполняется заново из reports. Читается уже под
+        # блокировкой транзакции, так что перестройку выполняет только один воркер
+        agg_version = c.execute("PRAGMA user_version").fetchone()[0]
+        rebuild_agg = agg_version < AGG_SCHEMA_VERSION
+        if rebuild_agg:
+            for trigger in ("trg_reports_agg_insert", "trg_reports_agg_delete", "trg_reports_agg_update"):
+                c.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+            c.execute("DROP TABLE IF EXISTS reports_daily_agg")
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS reports_daily_agg(
+          user_id    TEXT,
+          work_date  TEXT,
+          location   TEXT NOT NULL,
+          activity   TEXT NOT NULL,
+          hours_sum  INTEGER NOT NULL,
+          rows_count INTEGER NOT NULL,
+          PRIMARY KEY (user_id, work_date, location, activity)
+        )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_agg_workdate ON reports_daily_agg(work_date)")
+        c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_reports_agg_insert AFTER INSERT ON reports
+        BEGIN
+          INSERT INTO reports_daily_agg(user_id, work_date, location, activity, hours_sum, rows_count)
+          VALUES (NEW.user_id, NEW.work_date, coalesce(NEW.location, ''), coalesce(NEW.activity, ''),
+                  coalesce(NEW.hours, 0), 1)
+          ON CONFLICT(user_id, work_date, location, activity) DO UPDATE SET
+            hours_sum = hours_sum + excluded.hours_sum,
+            rows_count = rows_count + 1;
+        END
+        """)
+        c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_reports_agg_delete AFTER DELETE ON reports
+        BEGIN
+          UPDATE reports_daily_agg
+          SET hours_sum = hours_sum - coalesce(OLD.hours, 0), rows_count = rows_count - 1
+          WHERE user_id=OLD.user_id AND work_date=OLD.work_date
+            AND location=coalesce(OLD.location, '') AND activity=coalesce(OLD.activity, '');
+          DELETE FROM reports_daily_agg
+          WHERE user_id=OLD.user_id AND work_date=OLD.work_date
+            AND location=coalesce(OLD.location, '') AND activity=coalesce(OLD.activity, '')
+            AND rows_count <= 0;
+        END
+        """)
+        c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_reports_agg_update
+        AFTER UPDATE OF user_id, work_date, location, activity, hours ON reports
+        BEGIN
+          UPDATE reports_daily_agg
+          SET hours_sum = hours_sum - coalesce(OLD.hours, 0), rows_count = rows_count - 1
+          WHERE user_id=OLD.user_id AND work_date=OLD.work_date
+            AND location=coalesce(OLD.location, '') AND activity=coalesce(OLD.activity, '');
+          DELETE FROM reports_daily_agg
+          WHERE user_id=OLD.user_id AND work_date=OLD.work_date
+            AND location=coalesce(OLD.location, '') AND activity=coalesce(OLD.activity, '')
+            AND rows_count <= 0;
+          INSERT INTO reports_daily_agg(user_id, work_date, location, activity, hours_sum, rows_count)
+          VALUES (NEW.user_id, NEW.work_date, coalesce(NEW.location, ''), coalesce(NEW.activity, ''),
+                  coalesce(NEW.hours, 0), 1)
+          ON CONFLICT(user_id, work_date, location, activity) DO UPDATE SET
+            hours_sum = hours_sum + excluded.hours_sum,
+            rows_count = rows_count + 1;
+        END
+        """)
+        if rebuild_agg:
+            # Первый запуск с этой версией агрегатов - заполняем из накопленных отчётов
+            c.execute("""
+            INSERT INTO reports_daily_agg(user_id, work_date, location, activity, hours_sum, rows_count)
+            SELECT user_id, work_date, coalesce(location, ''), coalesce(activity, ''),
+                   coalesce(SUM(hours), 0), COUNT(*)
+            FROM reports
+            GROUP BY user_id, work_date, coalesce(location, ''), coalesce(activity, '')
+            """)
+            c.execute(f"PRAGMA user_version = {AGG_SCHEMA_VERSION}")
+
         def table_cols(table: str):
             return {r[1] for r in c.execute(f"PRAGMA table_info({table})").fetchall()}
 
@@ -220,43 +447,94 @@ def init_db():
                 )
             c.execute("UPDATE activities SET grp=? WHERE (grp IS NULL OR grp='')", (GROUP_HAND,))
 
-        for name in DEFAULT_FIELDS:
-            c.execute("INSERT OR IGNORE INTO locations(name, grp) VALUES (?, ?)", (name, GROUP_FIELDS))
-        c.execute("INSERT OR IGNORE INTO locations(name, grp) VALUES (?, ?)", ("Склад", GROUP_WARE))
-
-        for name in DEFAULT_TECH:
-            c.execute("INSERT OR IGNORE INTO activities(name, grp) VALUES (?, ?)", (name, GROUP_TECH))
-        for name in DEFAULT_HAND:
-            c.execute("INSERT OR IGNORE INTO activities(name, grp) VALUES (?, ?)", (name, GROUP_HAND))
+        # Справочники по умолчанию - пачкой, в той же транзакции, что и миграции
+        c.executemany(
+            "INSERT OR IGNORE INTO locations(name, grp) VALUES (?, ?)",
+            [(name, GROUP_FIELDS) for name in DEFAULT_FIELDS] + [("Склад", GROUP_WARE)]
+        )
+        c.executemany(
+            "INSERT OR IGNORE INTO activities(name, grp) VALUES (?, ?)",
+            [(name, GROUP_TECH) for name in DEFAULT_TECH] + [(name, GROUP_HAND) for name in DEFAULT_HAND]
+        )
 
         con.commit()
+        _invalidate_catalog()
 
-def upsert_user(user_id: str, full_name: Optional[str], tz: str):
-    now = datetime.now().isoformat()
-    with connect() as con, closing(con.cursor()) as c:
-        row = c.execute("SELECT user_id FROM users WHERE user_id=?", (user_id,)).fetchone()
-        if row:
-            c.execute("UPDATE users SET full_name=?, tz=?, created_at=? WHERE user_id=?",
-                      (full_name, tz, now, user_id))
-        else:
-            c.execute("INSERT INTO users(user_id, full_name, tz, created_at) VALUES(?,?,?,?)",
-                      (user_id, full_name, tz, now))
+        # Обновляет статистику планировщика (ANALYZE) только там, где она устарела
+        c.execute("PRAGMA optimize")
+
+# Профили пользователей читаются почти в каждом обработчике, а меняются только
+# через upsert_user - кэшируем на USER_CACHE_TTL секунд и сбрасываем при записи
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "30"))
+_user_cache: "TTLCache[str, dict]" = TTLCache(maxsize=STATE_CACHE_SIZE, ttl=USER_CACHE_TTL)
+_user_cache_lock = threading.Lock()
+
+def upsert_user(user_id: str, full_name: Optional[str], tz: str, now: Optional[str] = None):
+    now = now or datetime.now().isoformat()
+    # Один запрос вместо SELECT + UPDATE/INSERT (SQLite >= 3.24)
+    with WRITE_POOL.acquire() as con, closing(con.cursor()) as c:
+        c.execute("""
+        INSERT INTO users(user_id, full_name, tz, created_at) VALUES(?,?,?,?)
+        ON CONFLICT(user_id) DO UPDATE SET
+          full_name=excluded.full_name,
+          tz=excluded.tz,
+          created_at=excluded.created_at
+        """, (user_id, full_name, tz, now))
         con.commit()
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
 
 def get_user(user_id: str):
-    with connect() as con, closing(con.cursor()) as c:
+    with _user_cache_lock:
+        u = _user_cache.get(user_id)
+    if u is not None:
+        return dict(u)
+    with READ_POOL.acquire() as con, closing(con.cursor()) as c:
+        # sqlite3.Row только на этом курсоре: остальные запросы распаковывают кортежи
+        c.row_factory = sqlite3.Row
         r = c.execute("SELECT user_id, full_name, tz, created_at FROM users WHERE user_id=?", (user_id,)).fetchone()
         if not r:
             return None
-        return {
-            "user_id": r[0],
-            "full_name": r[1],
-            "tz": r[2] or TZ,
-            "created_at": r[3],
-        }
+        u = dict(r)
+        u["tz"] = u["tz"] or TZ
+    with _user_cache_lock:
+        _user_cache[user_id] = u
+    return dict(u)
+
+# Справочники (виды работ, места) меняет только админ, а читаются они
+# при каждом построении меню - держим их в памяти до ближайшего изменения
+# CATALOG_TTL_SECONDS - страховка на случай правки БД в обход бота
+CATALOG_TTL_SECONDS = int(os.getenv("CATALOG_TTL_SECONDS", "300"))
+_catalog_cache: Dict[tuple, Tuple[float, list]] = {}
+_catalog_version = 0
+_catalog_lock = threading.Lock()
+
+def _cached_catalog(key: tuple, load: Callable[[], list]) -> list:
+    entry = _catalog_cache.get(key)
+    now = time.monotonic()
+    if entry is not None and now - entry[0] < CATALOG_TTL_SECONDS:
+        cached = entry[1]
+    else:
+        version = _catalog_version
+        cached = load()
+        with _catalog_lock:
+            # Справочник изменился во время загрузки - не кэшируем устаревшее
+            if version == _catalog_version:
+                _catalog_cache[key] = (now, cached)
+    # Копия: вызывающий код может сохранить список в состоянии пользователя
+    return list(cached)
+
+def _invalidate_catalog():
+    global _catalog_version
+    with _catalog_lock:
+        _catalog_version += 1
+        _catalog_cache.clear()
 
 def list_activities(grp: str) -> List[str]:
-    with connect() as con, closing(con.cursor()) as c:
+    return _cached_catalog(("activities", grp), lambda: _load_activities(grp))
+
+def _load_activities(grp: str) -> List[str]:
+    with READ_POOL.acquire() as con, closing(con.cursor()) as c:
         rows = c.execute("SELECT name FROM activities WHERE grp=? ORDER BY name", (grp,)).fetchall()
         return [r[0] for r in rows]
 
@@ -265,7 +543,10 @@ def list_activities_with_id(grp: str) -> List[Tuple[int, str]]:
     Возвращает список (id, name) для видов работ в группе.
     Используется для формирования кнопок с ID в callback_data.
     """
-    with connect() as con, closing(con.cursor()) as c:
+    return _cached_catalog(("activities_with_id", grp), lambda: _load_activities_with_id(grp))
+
+def _load_activities_with_id(grp: str) -> List[Tuple[int, str]]:
+    with READ_POOL.acquire() as con, closing(con.cursor()) as c:
         rows = c.execute("SELECT id, name FROM activities WHERE grp=? ORDER BY name", (grp,)).fetchall()
         return [(r[0], r[1]) for r in rows]
 
@@ -273,7 +554,7 @@ def get_activity_name(act_id: int) -> Optional[Tuple[str, str]]:
     """
     Возвращает (name, grp) для activity по ID или None, если не найдено.
     """
-    with connect() as con, closing(con.cursor()) as c:
+    with READ_POOL.acquire() as con, closing(con.cursor()) as c:
         r = c.execute("SELECT name, grp FROM activities WHERE id=?", (act_id,)).fetchone()
         if not r:
             return None
@@ -283,22 +564,28 @@ def add_activity(grp: str, name: str) -> bool:
     name = name.strip()
     if not name:
         return False
-    with connect() as con, closing(con.cursor()) as c:
+    with WRITE_POOL.acquire() as con, closing(con.cursor()) as c:
         try:
             c.execute("INSERT INTO activities(name, grp) VALUES(?,?)", (name, grp))
             con.commit()
+            _invalidate_catalog()
             return True
         except sqlite3.IntegrityError:
             return False
 
 def remove_activity(name: str) -> bool:
-    with connect() as con, closing(con.cursor()) as c:
+    with WRITE_POOL.acquire() as con, closing(con.cursor()) as c:
         cur = c.execute("DELETE FROM activities WHERE name=?", (name,))
         con.commit()
+        if cur.rowcount > 0:
+            _invalidate_catalog()
         return cur.rowcount > 0
 
 def list_locations(grp: str) -> List[str]:
-    with connect() as con, closing(con.cursor()) as c:
+    return _cached_catalog(("locations", grp), lambda: _load_locations(grp))
+
+def _load_locations(grp: str) -> List[str]:
+    with READ_POOL.acquire() as con, closing(con.cursor()) as c:
         rows = c.execute("SELECT name FROM locations WHERE grp=? ORDER BY name", (grp,)).fetchall()
         return [r[0] for r in rows]
 
@@ -307,7 +594,10 @@ def list_locations_with_id(grp: str) -> List[Tuple[int, str]]:
     Возвращает список (id, name) для локаций в группе.
     Используется для формирования кнопок с ID в callback_data.
     """
-    with connect() as con, closing(con.cursor()) as c:
+    return _cached_catalog(("locations_with_id", grp), lambda: _load_locations_with_id(grp))
+
+def _load_locations_with_id(grp: str) -> List[Tuple[int, str]]:
+    with READ_POOL.acquire() as con, closing(con.cursor()) as c:
         rows = c.execute("SELECT id, name FROM locations WHERE grp=? ORDER BY name", (grp,)).fetchall()
         return [(r[0], r[1]) for r in rows]
 
@@ -315,7 +605,7 @@ def get_location_name(loc_id: int) -> Optional[Tuple[str, str]]:
     """
     Возвращает (name, grp) для location по ID или None, если не найдено.
     """
-    with connect() as con, closing(con.cursor()) as c:
+    with READ_POOL.acquire() as con, closing(con.cursor()) as c:
         r = c.execute("SELECT name, grp FROM locations WHERE id=?", (loc_id,)).fetchone()
         if not r:
             return None
@@ -325,24 +615,29 @@ def add_location(grp: str, name: str) -> bool:
     name = name.strip()
     if not name:
         return False
-    with connect() as con, closing(con.cursor()) as c:
+    with WRITE_POOL.acquire() as con, closing(con.cursor()) as c:
         try:
             c.execute("INSERT INTO locations(name, grp) VALUES(?,?)", (name, grp))
             con.commit()
+            _invalidate_catalog()
             return True
         except sqlite3.IntegrityError:
             return False
 
 def remove_location(name: str) -> bool:
-    with connect() as con, closing(con.cursor()) as c:
+    with WRITE_POOL.acquire() as con, closing(con.cursor()) as c:
         cur = c.execute("DELETE FROM locations WHERE name=?", (name,))
         con.commit()
+        if cur.rowcount > 0:
+            _invalidate_catalog()
         return cur.rowcount > 0
 
 def insert_report(user_id:str, reg_name:str, location:str, loc_grp:str,
-                  activity:str, act_grp:str, work_date:str, hours:int) -> int:
-    now = datetime.now().isoformat()
-    with connect() as con, closing(con.cursor()) as c:
+                  activity:str, act_grp:str, work_date:str, hours:int,
+                  now: Optional[str] = None) -> int:
+    # now можно передать снаружи, чтобы пачка записей получила одну метку времени
+    now = now or datetime.now().isoformat()
+    with WRITE_POOL.acquire() as con, closing(con.cursor()) as c:
         c.execute("""
         INSERT INTO reports(created_at, user_id, reg_name, location, location_grp,
                             activity, activity_grp, work_date, hours)
@@ -352,21 +647,16 @@ def insert_report(user_id:str, reg_name:str, location:str, loc_grp:str,
         return c.lastrowid
 
 def get_report(report_id:int):
-    with connect() as con, closing(con.cursor()) as c:
+    with READ_POOL.acquire() as con, closing(con.cursor()) as c:
+        c.row_factory = sqlite3.Row
         r = c.execute(
             "SELECT id, created_at, user_id, reg_name, location, location_grp, activity, activity_grp, work_date, hours FROM reports WHERE id=?",
             (report_id,)
         ).fetchone()
-        if not r:
-            return None
-        return {
-            "id": r[0], "created_at": r[1], "user_id": r[2], "reg_name": r[3],
-            "location": r[4], "location_grp": r[5], "activity": r[6], "activity_grp": r[7],
-            "work_date": r[8], "hours": r[9]
-        }
+        return dict(r) if r else None
 
 def sum_hours_for_user_date(user_id:str, work_date:str, exclude_report_id: Optional[int] = None) -> int:
-    with connect() as con, closing(con.cursor()) as c:
+    with READ_POOL.acquire() as con, closing(con.cursor()) as c:
         if exclude_report_id:
             r = c.execute("SELECT COALESCE(SUM(hours),0) FROM reports WHERE user_id=? AND work_date=? AND id<>?",
                           (user_id, work_date, exclude_report_id)).fetchone()
@@ -375,62 +665,79 @@ def sum_hours_for_user_date(user_id:str, work_date:str, exclude_report_id: Optio
                           (user_id, work_date)).fetchone()
         return int(r[0] or 0)
 
-def user_recent_24h_reports(user_id:str) -> List[tuple]:
+# Редактор записей листает отчёты за последние 24 часа по одной записи.
+# В состоянии хранится только "окно" (граница по времени, максимальный id и
+# число записей), сама запись на каждой странице читается из БД
+def open_edit_window(user_id: str) -> dict:
     cutoff = (datetime.now() - timedelta(hours=24)).isoformat()
-    with connect() as con, closing(con.cursor()) as c:
-        rows = c.execute("""
+    with READ_POOL.acquire() as con, closing(con.cursor()) as c:
+        count, max_id = c.execute(
+            "SELECT COUNT(*), COALESCE(MAX(id), 0) FROM reports WHERE user_id=? AND created_at>=?",
+            (user_id, cutoff)
+        ).fetchone()
+    # max_id фиксирует окно: новые записи не сдвигают уже открытые страницы
+    return {"since": cutoff, "max_id": max_id, "count": count}
+
+def count_edit_window(user_id: str, window: dict) -> int:
+    with READ_POOL.acquire() as con, closing(con.cursor()) as c:
+        return c.execute(
+            "SELECT COUNT(*) FROM reports WHERE user_id=? AND created_at>=? AND id<=?",
+            (user_id, window["since"], window["max_id"])
+        ).fetchone()[0]
+
+def get_edit_window_record(user_id: str, window: dict, offset: int) -> Optional[tuple]:
+    with READ_POOL.acquire() as con, closing(con.cursor()) as c:
+        return c.execute("""
         SELECT id, work_date, activity, location, hours, created_at
         FROM reports
-        WHERE user_id=? AND created_at>=?
-        ORDER BY created_at DESC
-        """, (user_id, cutoff)).fetchall()
-        return rows
+        WHERE user_id=? AND created_at>=? AND id<=?
+        ORDER BY created_at DESC, id DESC
+        LIMIT 1 OFFSET ?
+        """, (user_id, window["since"], window["max_id"], offset)).fetchone()
 
 def delete_report(report_id:int, user_id:str) -> bool:
-    with connect() as con, closing(con.cursor()) as c:
+    with WRITE_POOL.acquire() as con, closing(con.cursor()) as c:
         cur = c.execute("DELETE FROM reports WHERE id=? AND user_id=?", (report_id, user_id))
         con.commit()
         return cur.rowcount > 0
 
 def update_report_hours(report_id:int, user_id:str, new_hours:int) -> bool:
-    with connect() as con, closing(con.cursor()) as c:
+    with WRITE_POOL.acquire() as con, closing(con.cursor()) as c:
         cur = c.execute("UPDATE reports SET hours=? WHERE id=? AND user_id=?", (new_hours, report_id, user_id))
         con.commit()
         return cur.rowcount > 0
 
 def fetch_stats_today_all():
     today = date.today().isoformat()
-    with connect() as con, closing(con.cursor()) as c:
+    with READ_POOL.acquire() as con, closing(con.cursor()) as c:
         rows = c.execute("""
-        SELECT r.user_id, u.full_name, r.location, r.activity, SUM(r.hours) as h
-        FROM reports r
-        LEFT JOIN users u ON u.user_id=r.user_id
-        WHERE r.work_date=?
-        GROUP BY r.user_id, r.location, r.activity
-        ORDER BY u.full_name, r.location, r.activity
+        SELECT a.user_id, u.full_name, nullif(a.location, ''), nullif(a.activity, ''), a.hours_sum as h
+        FROM reports_daily_agg a
+        LEFT JOIN users u ON u.user_id=a.user_id
+        WHERE a.work_date=?
+        ORDER BY u.full_name, a.location, a.activity
         """, (today,)).fetchall()
         return rows
 
 def fetch_stats_range_for_user(user_id:str, start_date:str, end_date:str):
-    with connect() as con, closing(con.cursor()) as c:
+    with READ_POOL.acquire() as con, closing(con.cursor()) as c:
         rows = c.execute("""
-        SELECT work_date, location, activity, SUM(hours) as h
-        FROM reports
+        SELECT work_date, nullif(location, ''), nullif(activity, ''), hours_sum as h
+        FROM reports_daily_agg
         WHERE user_id=? AND work_date BETWEEN ? AND ?
-        GROUP BY work_date, location, activity
         ORDER BY work_date DESC
         """, (user_id, start_date, end_date)).fetchall()
         return rows
 
 def fetch_stats_range_all(start_date:str, end_date:str):
-    with connect() as con, closing(con.cursor()) as c:
+    with READ_POOL.acquire() as con, closing(con.cursor()) as c:
         rows = c.execute("""
-        SELECT u.full_name, work_date, location, activity, SUM(hours) as h
-        FROM reports r
-        LEFT JOIN users u ON u.user_id=r.user_id
+        SELECT u.full_name, work_date, nullif(location, ''), nullif(activity, ''), SUM(a.hours_sum) as h
+        FROM reports_daily_agg a
+        LEFT JOIN users u ON u.user_id=a.user_id
         WHERE work_date BETWEEN ? AND ?
         GROUP BY u.full_name, work_date, location, activity
-        ORDER BY work_date DESC, u.full_name
+        ORDER BY u.full_name, work_date DESC
         """, (start_date, end_date)).fetchall()
         return rows
 
@@ -438,9 +745,23 @@ def fetch_stats_range_all(start_date:str, end_date:str):
 # Google Sheets API (та же логика)
 # -----------------------------
 
+# Кэш учётных данных и клиентов Google API: token.json читается один раз,
+# discovery-документы не запрашиваются на каждый экспорт
+_CREDS: Optional[Credentials] = None
+_creds_lock = threading.Lock()
+# Клиенты googleapiclient (httplib2) не потокобезопасны - свои на каждый поток
+_google_services = threading.local()
+
 def get_google_credentials():
-    creds = None
-    if TOKEN_JSON_PATH.exists():
+    global _CREDS
+    with _creds_lock:
+        if _CREDS and _CREDS.valid:
+            return _CREDS
+        _CREDS = _load_google_credentials(_CREDS)
+        return _CREDS
+
+def _load_google_credentials(creds: Optional[Credentials]):
+    if creds is None and TOKEN_JSON_PATH.exists():
         creds = Credentials.from_authorized_user_file(str(TOKEN_JSON_PATH), GOOGLE_SCOPES)
     
     if not creds or not creds.valid:
@@ -459,96 +780,139 @@ def get_google_credentials():
     
     return creds
 
+def _google_service(name: str, version: str):
+    """
+    Возвращает клиент Google API (sheets/drive), созданный один раз на поток.
+    Клиент пересоздаётся, только если сменились учётные данные.
+    """
+    creds = get_google_credentials()
+    if not creds:
+        return None
+    key = (name, version)
+    cache = getattr(_google_services, "cache", None)
+    if cache is None:
+        cache = _google_services.cache = {}
+    cached = cache.get(key)
+    if cached and cached[0] is creds:
+        return cached[1]
+    service = build(name, version, credentials=creds, cache_discovery=False)
+    cache[key] = (creds, service)
+    return service
+
 def get_or_create_monthly_sheet(year: int, month: int):
-    with connect() as con, closing(con.cursor()) as c:
+    with READ_POOL.acquire() as con, closing(con.cursor()) as c:
         row = c.execute(
             "SELECT spreadsheet_id, sheet_url FROM monthly_sheets WHERE year=? AND month=?",
             (year, month)
         ).fetchone()
+    
+    if row:
+        return row[0], row[1]
+    
+    # Запросы к Google идут без удержания соединения с БД
+    try:
+        drive = _google_service("drive", "v3")
+        sheets = _google_service("sheets", "v4")
+        if not drive or not sheets:
+            return None, None
         
-        if row:
-            return row[0], row[1]
+        sheet_name = f"{EXPORT_PREFIX}_WA_{year}_{month:02d}"
         
-        try:
-            creds = get_google_credentials()
-            if not creds:
-                return None, None
-            
-            drive = build("drive", "v3", credentials=creds)
-            sheets = build("sheets", "v4", credentials=creds)
-            
-            sheet_name = f"{EXPORT_PREFIX}_WA_{year}_{month:02d}"
-            
-            file_metadata = {
-                "name": sheet_name,
-                "mimeType": "application/vnd.google-apps.spreadsheet",
-            }
-            if DRIVE_FOLDER_ID:
-                file_metadata["parents"] = [DRIVE_FOLDER_ID]
-            
-            file = drive.files().create(
-                body=file_metadata,
-                fields="id, webViewLink"
-            ).execute()
-            
-            spreadsheet_id = file["id"]
-            sheet_url = file["webViewLink"]
-            
-            headers = [["Дата", "Фамилия Имя", "Место работы", "Вид работы", "Количество часов"]]
-            sheets.spreadsheets().values().update(
-                spreadsheetId=spreadsheet_id,
-                range="A1:E1",
-                valueInputOption="RAW",
-                body={"values": headers}
-            ).execute()
-            
-            requests = [{
-                "repeatCell": {
-                    "range": {
-                        "sheetId": 0,
-                        "startRowIndex": 0,
-                        "endRowIndex": 1
-                    },
-                    "cell": {
-                        "userEnteredFormat": {
-                            "textFormat": {"bold": True}
+        file_metadata = {
+            "name": sheet_name,
+            "mimeType": "application/vnd.google-apps.spreadsheet",
+        }
+        if DRIVE_FOLDER_ID:
+            file_metadata["parents"] = [DRIVE_FOLDER_ID]
+        
+        file = drive.files().create(
+            body=file_metadata,
+            fields="id, webViewLink"
+        ).execute()
+        
+        spreadsheet_id = file["id"]
+        sheet_url = file["webViewLink"]
+        
+        # Заголовки и жирный шрифт - одним batchUpdate (updateCells),
+        # а не отдельными values().update и repeatCell
+        headers = ["Дата", "Фамилия Имя", "Место работы", "Вид работы", "Количество часов"]
+        requests = [{
+            "updateCells": {
+                "start": {"sheetId": 0, "rowIndex": 0, "columnIndex": 0},
+                "rows": [{
+                    "values": [
+                        {
+                            "userEnteredValue": {"stringValue": h},
+                            "userEnteredFormat": {"textFormat": {"bold": True}},
                         }
-                    },
-                    "fields": "userEnteredFormat.textFormat.bold"
-                }
-            }]
-            sheets.spreadsheets().batchUpdate(
-                spreadsheetId=spreadsheet_id,
-                body={"requests": requests}
-            ).execute()
-            
+                        for h in headers
+                    ]
+                }],
+                "fields": "userEnteredValue,userEnteredFormat.textFormat.bold"
+            }
+        }]
+        sheets.spreadsheets().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={"requests": requests}
+        ).execute()
+        
+        with WRITE_POOL.acquire() as con, closing(con.cursor()) as c:
             c.execute(
                 "INSERT INTO monthly_sheets(year, month, spreadsheet_id, sheet_url, created_at) VALUES(?,?,?,?,?)",
                 (year, month, spreadsheet_id, sheet_url, datetime.now().isoformat())
             )
             con.commit()
-            
-            logging.info(f"Created new sheet for {year}-{month:02d}: {sheet_url}")
-            return spreadsheet_id, sheet_url
-            
-        except HttpError as e:
-            logging.error(f"Google API error: {e}")
-            return None, None
-        except Exception as e:
-            logging.error(f"Error creating sheet: {e}")
-            return None, None
+        
+        logging.info(f"Created new sheet for {year}-{month:02d}: {sheet_url}")
+        return spreadsheet_id, sheet_url
+        
+    except HttpError as e:
+        logging.error(f"Google API error: {e}")
+        return None, None
+    except Exception as e:
+        logging.error(f"Error creating sheet: {e}")
+        return None, None
+
+def get_export_cursor() -> int:
+    """
+    Курсор экспорта: все отчёты с id <= курсора уже выгружены в Google Sheets.
+    """
+    with READ_POOL.acquire() as con, closing(con.cursor()) as c:
+        r = c.execute("SELECT last_report_id FROM export_cursor WHERE id=1").fetchone()
+        return int(r[0]) if r else 0
+
+def advance_export_cursor(last_report_id: int):
+    with WRITE_POOL.acquire() as con, closing(con.cursor()) as c:
+        c.execute("""
+        INSERT INTO export_cursor(id, last_report_id) VALUES(1, ?)
+        ON CONFLICT(id) DO UPDATE SET last_report_id=MAX(last_report_id, excluded.last_report_id)
+        """, (last_report_id,))
+        con.commit()
 
 def get_unexported_reports():
-    with connect() as con, closing(con.cursor()) as c:
+    # Поиск по диапазону id после курсора вместо просмотра всей таблицы;
+    # NOT EXISTS страхует от повторной выгрузки внутри диапазона
+    cursor_id = get_export_cursor()
+    with READ_POOL.acquire() as con, closing(con.cursor()) as c:
         rows = c.execute("""
         SELECT r.id, r.work_date, r.reg_name, r.location, r.activity, r.hours
         FROM reports r
-        LEFT JOIN google_exports ge ON r.id = ge.report_id
-        WHERE ge.report_id IS NULL
+        WHERE r.id > ?
+          AND NOT EXISTS (SELECT 1 FROM google_exports ge WHERE ge.report_id = r.id)
         ORDER BY r.work_date, r.created_at
-        """).fetchall()
+        """, (cursor_id,)).fetchall()
         return rows
 
+_A1_ROW_RE = re.compile(r"![A-Z]+(\d+)")
+
+def _first_row_of_range(a1_range: str) -> Optional[int]:
+    """
+    Номер первой строки из диапазона A1 ответа Sheets API,
+    например "'WorkLog'!A5:E7" -> 5. None, если разобрать не удалось.
+    """
+    m = _A1_ROW_RE.search(a1_range or "")
+    return int(m.group(1)) if m else None
+
 def export_reports_to_sheets():
     unexported = get_unexported_reports()
     
@@ -557,12 +921,10 @@ def export_reports_to_sheets():
         return 0, "Нет новых отчетов для экспорта"
     
     try:
-        creds = get_google_credentials()
-        if not creds:
+        sheets_service = _google_service("sheets", "v4")
+        if not sheets_service:
             return 0, "Ошибка авторизации Google"
         
-        sheets_service = build("sheets", "v4", credentials=creds)
-        
         reports_by_month = {}
         for report_id, work_date, name, location, activity, hours in unexported:
             d = datetime.fromisoformat(work_date)
@@ -571,8 +933,8 @@ def export_reports_to_sheets():
                 reports_by_month[key] = []
             reports_by_month[key].append((report_id, work_date, name, location, activity, hours))
         
-        total_exported = 0
-        
+        # Готовим append для каждого месяца (у каждого месяца своя таблица)
+        pending = []
         for (year, month), reports in reports_by_month.items():
             spreadsheet_id, sheet_url = get_or_create_monthly_sheet(year, month)
             
@@ -580,43 +942,74 @@ def export_reports_to_sheets():
                 logging.error(f"Failed to get/create sheet for {year}-{month}")
                 continue
             
-            try:
-                result = sheets_service.spreadsheets().values().get(
-                    spreadsheetId=spreadsheet_id,
-                    range="A:E"
-                ).execute()
-                existing_values = result.get("values", [])
-                next_row = len(existing_values) + 1
-            except HttpError:
-                next_row = 2
-            
-            values_to_append = []
-            export_records = []
-            
-            for report_id, work_date, name, location, activity, hours in reports:
-                values_to_append.append([work_date, name, location, activity, hours])
-                export_records.append((report_id, spreadsheet_id, f"{year}-{month:02d}", next_row))
-                next_row += 1
-            
+            values_to_append = [
+                [work_date, name, location, activity, hours]
+                for _, work_date, name, location, activity, hours in reports
+            ]
             if values_to_append:
+                pending.append((year, month, spreadsheet_id, reports, values_to_append))
+        
+        # Все append одним HTTP-запросом (batch); строку вставки определяет
+        # сам append - лист целиком не читаем
+        responses = {}
+        
+        def _on_append(request_id, response, exception):
+            responses[request_id] = (response, exception)
+        
+        batch = sheets_service.new_batch_http_request(callback=_on_append)
+        for idx, (year, month, spreadsheet_id, reports, values_to_append) in enumerate(pending):
+            batch.add(
                 sheets_service.spreadsheets().values().append(
                     spreadsheetId=spreadsheet_id,
                     range="A:E",
                     valueInputOption="RAW",
+                    insertDataOption="INSERT_ROWS",
                     body={"values": values_to_append}
-                ).execute()
-                
-                now = datetime.now().isoformat()
-                with connect() as con, closing(con.cursor()) as c:
-                    for report_id, ss_id, sheet_name, row_num in export_records:
-                        c.execute(
-                            "INSERT INTO google_exports(report_id, spreadsheet_id, sheet_name, row_number, exported_at, last_updated) VALUES(?,?,?,?,?,?)",
-                            (report_id, ss_id, sheet_name, row_num, now, now)
-                        )
-                    con.commit()
-                
-                total_exported += len(values_to_append)
-                logging.info(f"Exported {len(values_to_append)} reports to {year}-{month:02d}")
+                ),
+                request_id=str(idx)
+            )
+        if pending:
+            batch.execute()
+        
+        total_exported = 0
+        exported_ids = set()
+        # Одна метка времени на весь экспорт
+        now = datetime.now().isoformat(timespec="seconds")
+        
+        for idx, (year, month, spreadsheet_id, reports, values_to_append) in enumerate(pending):
+            response, exception = responses.get(str(idx), (None, None))
+            if exception is not None or response is None:
+                logging.error(f"Failed to append reports to {year}-{month:02d}: {exception}")
+                continue
+            
+            updated_range = response.get("updates", {}).get("updatedRange", "")
+            next_row = _first_row_of_range(updated_range) or 2
+            export_records = [
+                (report[0], spreadsheet_id, f"{year}-{month:02d}", next_row + i)
+                for i, report in enumerate(reports)
+            ]
+            
+            # Одна транзакция (BEGIN IMMEDIATE) и один подготовленный запрос на всю пачку
+            with WRITE_POOL.acquire() as con, closing(con.cursor()) as c:
+                c.executemany(
+                    "INSERT INTO google_exports(report_id, spreadsheet_id, sheet_name, row_number, exported_at, last_updated) VALUES(?,?,?,?,?,?)",
+                    [(report_id, ss_id, sheet_name, row_num, now, now)
+                     for report_id, ss_id, sheet_name, row_num in export_records]
+                )
+                con.commit()
+            
+            exported_ids.update(report[0] for report in reports)
+            total_exported += len(values_to_append)
+            logging.info(f"Exported {len(values_to_append)} reports to {year}-{month:02d}")
+        
+        # Курсор сдвигается только до первого невыгруженного отчёта,
+        # чтобы он попал в следующий экспорт
+        failed_ids = [report[0] for report in unexported if report[0] not in exported_ids]
+        if failed_ids:
+            new_cursor = min(failed_ids) - 1
+        else:
+            new_cursor = max(report[0] for report in unexported)
+        advance_export_cursor(new_cursor)
         
         return total_exported, f"Экспортировано записей: {total_exported}"
         
@@ -627,6 +1020,14 @@ def export_reports_to_sheets():
         logging.error(f"Error during export: {e}")
         return 0, f"Ошибка экспорта: {str(e)}"
 
+# Экспорт по кнопке админа выполняется в отдельном потоке. Ручной и плановый
+# экспорт не должны идти одновременно: оба сдвигают курсор выгрузки
+_export_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="export")
+_export_lock = threading.Lock()
+
+# Месяцы, таблица которых уже точно есть: повторные проверки без запроса к БД
+_known_month_sheets: set = set()
+
 def check_and_create_next_month_sheet():
     today = date.today()
     last_day = calendar.monthrange(today.year, today.month)[1]
@@ -638,19 +1039,25 @@ def check_and_create_next_month_sheet():
         else:
             next_year, next_month = today.year, today.month + 1
         
-        with connect() as con, closing(con.cursor()) as c:
+        if (next_year, next_month) in _known_month_sheets:
+            return False, "Не требуется создание таблицы"
+        
+        with READ_POOL.acquire() as con, closing(con.cursor()) as c:
             row = c.execute(
                 "SELECT spreadsheet_id FROM monthly_sheets WHERE year=? AND month=?",
                 (next_year, next_month)
             ).fetchone()
-            
-            if not row:
-                logging.info(f"Creating sheet for next month: {next_year}-{next_month:02d}")
-                spreadsheet_id, sheet_url = get_or_create_monthly_sheet(next_year, next_month)
-                if spreadsheet_id:
-                    return True, f"Создана таблица для {next_year}-{next_month:02d}: {sheet_url}"
-                else:
-                    return False, "Ошибка создания таблицы"
+        
+        if row:
+            _known_month_sheets.add((next_year, next_month))
+        else:
+            logging.info(f"Creating sheet for next month: {next_year}-{next_month:02d}")
+            spreadsheet_id, sheet_url = get_or_create_monthly_sheet(next_year, next_month)
+            if spreadsheet_id:
+                _known_month_sheets.add((next_year, next_month))
+                return True, f"Создана таблица для {next_year}-{next_month:02d}: {sheet_url}"
+            else:
+                return False, "Ошибка создания таблицы"
     
     return False, "Не требуется создание таблицы"
 
@@ -665,52 +1072,40 @@ def is_admin(user_id: str) -> bool:
 # Pagination Helper (для соблюдения ограничения WhatsApp ≤3 кнопок)
 # -----------------------------
 
-@dataclass
-class PaginationButton:
-    """Структура для кнопки в пагинации."""
-    title: str
-    callback_data: str
-
-def send_paginated_buttons(
-    client: WhatsApp,
-    to: str,
-    text: str,
-    items: list,
-    make_button: Callable[[Any], PaginationButton | Button],
+# Кнопки страницы зависят только от списка, префикса callback и номера
+# страницы - повторное листание тех же страниц берёт готовый набор из кэша.
+# Изменение справочника даёт другой items, поэтому сбрасывать кэш не нужно
+@functools.lru_cache(maxsize=256)
+def _build_page_buttons(
+    items: tuple,
+    callback_prefix: str,
     state_key: str,
-    page: int = 0,
-    back_cb: Optional[str] = None
-) -> None:
+    page: int,
+    back_cb: Optional[str],
+) -> Tuple[Tuple[Button, ...], int, int]:
     """
-    Стабильная пагинация под WhatsApp:
-    - максимум 3 кнопки на экран;
-    - на странице 1–2 item-кнопки + 1 навкнопка (⬅️ или ➡️) ИЛИ "Назад";
-    - страничность не «плавает» — шаг всегда одинаковый.
+    Возвращает (кнопки, номер страницы после ограничения, число страниц).
+    
+    Элемент списка - пара (id, название) или само значение (например, часы):
+    callback_data = callback_prefix + id/значение.
     """
-    if not items:
-        client.send_message(to=to, text=f"{text}\n\n_(Список пуст)_")
-        return
-
     base_capacity = 2  # столько item-кнопок помещаем на страницу стабильно
     total_items = len(items)
     total_pages = (total_items + base_capacity - 1) // base_capacity
     page = max(0, min(page, total_pages - 1))
 
     start = page * base_capacity
-    end = min(start + base_capacity, total_items)
-    page_items = items[start:end]
+    page_items = items[start:start + base_capacity]
 
     has_prev = page > 0
     has_next = page < total_pages - 1
 
-    # Сконструировать item-кнопки
-    btns: list[Button] = []
-    for it in page_items:
-        b = make_button(it)
-        if isinstance(b, Button):
-            btns.append(b)
-        else:
-            btns.append(Button(title=b.title, callback_data=b.callback_data))
+    # Сконструировать item-кнопки (только для видимой страницы)
+    btns = [
+        Button(title=it[1], callback_data=f"{callback_prefix}{it[0]}") if isinstance(it, tuple)
+        else Button(title=str(it), callback_data=f"{callback_prefix}{it}")
+        for it in page_items
+    ]
 
     # Навигация: приоритет одной стрелки, чтобы вместе с "Назад" не пробить лимит
     if has_prev and len(btns) < 3:
@@ -721,8 +1116,35 @@ def send_paginated_buttons(
     if back_cb and len(btns) < 3:
         btns.append(Button(title="🔙 Назад", callback_data=back_cb))
 
+    return tuple(btns[:3]), page, total_pages
+
+def send_paginated_buttons(
+    client: WhatsApp,
+    to: str,
+    text: str,
+    items: list,
+    callback_prefix: str,
+    state_key: str,
+    page: int = 0,
+    back_cb: Optional[str] = None
+) -> None:
+    """
+    Стабильная пагинация под WhatsApp:
+    - максимум 3 кнопки на экран;
+    - на странице 1–2 item-кнопки + 1 навкнопка (⬅️ или ➡️) ИЛИ "Назад";
+    - страничность не «плавает» — шаг всегда одинаковый.
+    """
+    if not items:
+        client.send_message(to=to, text=f"{text}\n\n_(Список пуст)_")
+        return
+
+    btns, page, total_pages = _build_page_buttons(
+        tuple(tuple(it) if isinstance(it, list) else it for it in items),
+        callback_prefix, state_key, page, back_cb
+    )
+
     page_info = f"\n\n_Страница {page+1} из {total_pages}_" if total_pages > 1 else ""
-    client.send_message(to=to, text=text + page_info, buttons=btns[:3])
+    client.send_message(to=to, text=text + page_info, buttons=list(btns))
 
 def show_main_menu(wa: WhatsApp, user_id: str, u: dict):
     """
@@ -765,28 +1187,31 @@ def show_more_menu(wa: WhatsApp, user_id: str):
 
     wa.send_message(to=user_id, text="Доп. меню:", buttons=buttons)
 
-def render_edit_records_page(client: WhatsApp, user_id: str, records: list, page: int = 0):
+def render_edit_records_page(client: WhatsApp, user_id: str, window: Optional[dict], page: int = 0,
+                             header_text: Optional[str] = None):
     """
     Отображает страницу редактора записей.
     
     # WA: Показываем 1 запись с 2 кнопками действий (Править, Удалить) + навигация
     # Итого максимум 3 кнопки: либо [Править, Удалить, ⬅️/➡️/Назад]
-    """
-    if not records:
-        client.send_message(to=user_id, text="📝 Записей нет.")
-        return
     
-    total_records = len(records)
-    if page < 0:
-        page = 0
-    if page >= total_records:
-        page = total_records - 1
+    window - окно записей из open_edit_window(); запись страницы читается из БД.
+    header_text (например, "✅ Обновлено") выводится над записью в том же
+    сообщении - без отдельной отправки.
+    """
+    prefix = f"{header_text}\n\n" if header_text else ""
+    total_records = window["count"] if window else 0
+    page = max(0, min(page, total_records - 1))
     
     # Текущая запись
-    rid, d, act, loc, h, created = records[page]
+    record = get_edit_window_record(user_id, window, page) if total_records else None
+    if not record:
+        client.send_message(to=user_id, text=f"{prefix}📝 Записей нет.")
+        return
+    rid, d, act, loc, h, created = record
     
     text = (
-        f"📝 *Запись {page + 1} из {total_records}*\n\n"
+        f"{prefix}📝 *Запись {page + 1} из {total_records}*\n\n"
         f"ID: `#{rid}`\n"
         f"Дата: *{d}*\n"
         f"Место: *{loc}*\n"
@@ -796,24 +1221,58 @@ def render_edit_records_page(client: WhatsApp, user_id: str, records: list, page
         f"Листайте стрелками ⬅️/➡️, чтобы посмотреть другие записи."
     )
     
-    buttons = []
+    # WA: Кнопки действий для текущей записи + третья кнопка:
+    # навигация (если записей >1) либо "Назад" в меню
+    if page > 0:
+        third = Button(title="⬅️", callback_data=f"nav:edit_records:{page-1}")
+    elif page < total_records - 1:
+        third = Button(title="➡️", callback_data=f"nav:edit_records:{page+1}")
+    else:
+        third = Button(title="🔙 Меню", callback_data="menu:root")
     
-    # WA: Кнопки действий для текущей записи
-    buttons.append(Button(title="🖊 Править", callback_data=f"edit:chg:{rid}:{d}"))
-    buttons.append(Button(title="🗑 Удалить", callback_data=f"edit:del:{rid}"))
+    buttons = [
+        Button(title="🖊 Править", callback_data=f"edit:chg:{rid}:{d}"),
+        Button(title="🗑 Удалить", callback_data=f"edit:del:{rid}"),
+        third,
+    ]
+    
+    client.send_message(to=user_id, text=text, buttons=buttons)  # WA: hard limit 3
+
+# WA: текст сообщения не длиннее 4096 символов - длинные отчёты режем с запасом
+TEXT_CHUNK_LIMIT = 3800
+
+def pack_text_blocks(blocks: List[str], limit: int = TEXT_CHUNK_LIMIT) -> List[str]:
+    """
+    Склеивает блоки текста (через перевод строки) в сообщения не длиннее limit.
     
-    # WA: Навигация (если записей >1)
-    if total_records > 1:
-        if page > 0:
-            buttons.append(Button(title="⬅️", callback_data=f"nav:edit_records:{page-1}"))
-        elif page < total_records - 1:
-            buttons.append(Button(title="➡️", callback_data=f"nav:edit_records:{page+1}"))
+    Блок (например, отчёт по одному сотруднику) между сообщениями не делится;
+    построчно режется только блок, который сам длиннее limit.
+    """
+    chunks: List[str] = []
+    buf: List[str] = []
+    size = 0
     
-    # Если есть место, добавляем кнопку "Назад"
-    if len(buttons) < 3:
-        buttons.append(Button(title="🔙 Меню", callback_data="menu:root"))
+    def flush():
+        nonlocal size
+        if buf:
+            chunks.append("\n".join(buf).strip())
+            buf.clear()
+            size = 0
     
-    client.send_message(to=user_id, text=text, buttons=buttons[:3])  # WA: hard limit 3
+    for block in blocks:
+        pieces = block.split("\n") if len(block) > limit else [block]
+        for piece in pieces:
+            if size and size + 1 + len(piece) > limit:
+                flush()
+            buf.append(piece[:limit])
+            size += len(piece[:limit]) + (1 if size else 0)
+    flush()
+    return chunks
+
+def send_text_blocks(client: WhatsApp, user_id: str, blocks: List[str]):
+    """Отправляет блоки текста одним или несколькими сообщениями (см. pack_text_blocks)."""
+    for chunk in pack_text_blocks(blocks):
+        client.send_message(to=user_id, text=chunk)
 
 # Инициализация Flask приложения
 app = Flask(__name__)
@@ -827,13 +1286,50 @@ wa = WhatsApp(
     webhook_endpoint="/webhook",
 )
 
+# Апдейты обрабатываются вне потока webhook: ответ 200 уходит сразу, а апдейты
+# разных пользователей идут параллельно (до MESSAGE_CONCURRENCY одновременно).
+# Пользователь всегда попадает в один и тот же однопоточный исполнитель,
+# поэтому его собственные сообщения обрабатываются строго по порядку
+MESSAGE_CONCURRENCY = max(1, int(os.getenv("MESSAGE_CONCURRENCY", "5")))
+_handler_ctx = threading.local()
+
+def _mark_handler_thread():
+    _handler_ctx.active = True
+
+_handler_executors = [
+    ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"wa-handler-{i}",
+                       initializer=_mark_handler_thread)
+    for i in range(MESSAGE_CONCURRENCY)
+]
+
+def _run_handler(func: Callable, client: WhatsApp, update):
+    try:
+        func(client, update)
+    except Exception:
+        logging.exception(f"Handler {func.__name__} failed")
+
+def in_background(func: Callable) -> Callable:
+    """Переносит обработчик pywa в пул исполнителей.
+
+    Вызов из другого обработчика (например, cmd_start из handle_text)
+    выполняется сразу, в текущем потоке.
+    """
+    @functools.wraps(func)
+    def wrapper(client: WhatsApp, update):
+        if getattr(_handler_ctx, "active", False):
+            return func(client, update)
+        user_id = update.from_user.wa_id
+        executor = _handler_executors[hash(user_id) % len(_handler_executors)]
+        executor.submit(_run_handler, func, client, update)
+    return wrapper
+
 # -----------------------------
 # Обработчики команд
 # -----------------------------
 
 @wa.on_message(text == "start")
+@in_background
 def cmd_start(client: WhatsApp, msg: WAMessage):
-    init_db()
     user_id = msg.from_user.wa_id
     upsert_user(user_id, None, TZ)
     u = get_user(user_id)
@@ -849,12 +1345,14 @@ def cmd_start(client: WhatsApp, msg: WAMessage):
     show_main_menu(client, user_id, u)
 
 @wa.on_message(text == "menu")
+@in_background
 def cmd_menu(client: WhatsApp, msg: WAMessage):
     user_id = msg.from_user.wa_id
     u = get_user(user_id)
     show_main_menu(client, user_id, u)
 
 @wa.on_message(text == "today")
+@in_background
 def cmd_today(client: WhatsApp, msg: WAMessage):
     user_id = msg.from_user.wa_id
     admin = is_admin(user_id)
@@ -862,29 +1360,23 @@ def cmd_today(client: WhatsApp, msg: WAMessage):
     if admin:
         rows = fetch_stats_today_all()
         if not rows:
-            text = "📊 Сегодня записей нет."
+            blocks = ["📊 Сегодня записей нет."]
         else:
-            parts = ["📊 *Сегодня (все)*:"]
-            cur_uid = None
-            subtotal = 0
-            for uid, full_name, loc, act, h in rows:
-                if uid != cur_uid:
-                    if cur_uid is not None:
-                        parts.append(f"  — Итого сотрудник: *{subtotal}* ч\n")
-                    cur_uid = uid
-                    subtotal = 0
-                    who = full_name or str(uid)
-                    parts.append(f"\n👤 *{who}*")
-                parts.append(f"  • {loc} — {act}: *{h}* ч")
-                subtotal += h
-            if cur_uid is not None:
-                parts.append(f"  — Итого сотрудник: *{subtotal}* ч")
-            text = "\n".join(parts)
+            # Блок на сотрудника: при разбиении на сообщения блоки не рвутся
+            blocks = ["📊 *Сегодня (все)*:"]
+            for uid, group in groupby(rows, key=itemgetter(0)):
+                group = list(group)
+                who = group[0][1] or str(uid)
+                lines = [f"\n👤 *{who}*"]
+                lines.extend(f"  • {loc} — {act}: *{h}* ч" for _, _, loc, act, h in group)
+                lines.append(f"  — Итого сотрудник: *{sum(r[4] for r in group)}* ч\n")
+                blocks.append("\n".join(lines))
+            blocks[-1] = blocks[-1].rstrip("\n")
     else:
         today = date.today().isoformat()
         rows = fetch_stats_range_for_user(user_id, today, today)
         if not rows:
-            text = "📊 Сегодня у вас записей нет."
+            blocks = ["📊 Сегодня у вас записей нет."]
         else:
             parts = ["📊 *Сегодня*:"]
             total = 0
@@ -892,11 +1384,12 @@ def cmd_today(client: WhatsApp, msg: WAMessage):
                 parts.append(f"• {loc} — {act}: *{h}* ч")
                 total += h
             parts.append(f"\nИтого: *{total}* ч")
-            text = "\n".join(parts)
+            blocks = ["\n".join(parts)]
     
-    client.send_message(to=user_id, text=text)
+    send_text_blocks(client, user_id, blocks)
 
 @wa.on_message(text == "my")
+@in_background
 def cmd_my(client: WhatsApp, msg: WAMessage):
     user_id = msg.from_user.wa_id
     admin = is_admin(user_id)
@@ -906,332 +1399,262 @@ def cmd_my(client: WhatsApp, msg: WAMessage):
     if admin:
         rows = fetch_stats_range_all(start.isoformat(), end.isoformat())
         if not rows:
-            text = "📊 За 7 дней записей нет."
+            blocks = ["📊 За 7 дней записей нет."]
         else:
-            parts = [f"📊 *Неделя* ({start.strftime('%d.%m')}–{end.strftime('%d.%m')}):"]
-            cur_user = None
-            subtotal = 0
-            for full_name, d, loc, act, h in rows:
-                who = full_name or "—"
-                if who != cur_user:
-                    if cur_user is not None:
-                        parts.append(f"  — Итого сотрудник: *{subtotal}* ч\n")
-                    cur_user = who
-                    subtotal = 0
-                    parts.append(f"\n👤 *{who}*")
-                parts.append(f"  • {d} | {loc} — {act}: *{h}* ч")
-                subtotal += h
-            if cur_user is not None:
-                parts.append(f"  — Итого сотрудник: *{subtotal}* ч")
-            text = "\n".join(parts)
+            blocks = [f"📊 *Неделя* ({start.strftime('%d.%m')}–{end.strftime('%d.%m')}):"]
+            for who, group in groupby(rows, key=lambda r: r[0] or "—"):
+                group = list(group)
+                lines = [f"\n👤 *{who}*"]
+                lines.extend(f"  • {d} | {loc} — {act}: *{h}* ч" for _, d, loc, act, h in group)
+                lines.append(f"  — Итого сотрудник: *{sum(r[4] for r in group)}* ч\n")
+                blocks.append("\n".join(lines))
+            blocks[-1] = blocks[-1].rstrip("\n")
     else:
         rows = fetch_stats_range_for_user(user_id, start.isoformat(), end.isoformat())
         if not rows:
-            text = "📊 За 7 дней у вас записей нет."
+            blocks = ["📊 За 7 дней у вас записей нет."]
         else:
             parts = [f"📊 *Неделя* ({start.strftime('%d.%m')}–{end.strftime('%d.%m')}):"]
-            per_day = {}
-            total = 0
-            for d, loc, act, h in rows:
-                per_day.setdefault(d, []).append((loc, act, h))
-            for d in sorted(per_day.keys(), reverse=True):
+            # Строки уже отсортированы по дате (DESC) - группируем подряд идущие
+            for d, group in groupby(rows, key=itemgetter(0)):
                 parts.append(f"\n*{d}*")
-                for loc, act, h in per_day[d]:
-                    parts.append(f"• {loc} — {act}: *{h}* ч")
-                    total += h
-            parts.append(f"\nИтого: *{total}* ч")
-            text = "\n".join(parts)
+                parts.extend(f"• {loc} — {act}: *{h}* ч" for _, loc, act, h in group)
+            parts.append(f"\nИтого: *{sum(r[3] for r in rows)}* ч")
+            blocks = ["\n".join(parts)]
     
-    client.send_message(to=user_id, text=text)
+    send_text_blocks(client, user_id, blocks)
 
 # -----------------------------
 # Обработка callback кнопок
 # -----------------------------
 
-@wa.on_callback_button()
-def handle_callback(client: WhatsApp, btn):
-    user_id = btn.from_user.wa_id
-    data = btn.data
-    
-    # WA: Обработка навигации по страницам (для пагинации)
-    if data.startswith("nav:"):
-        parts = data.split(":")
-        if len(parts) < 3:
-            client.send_message(to=user_id, text="❌ Команда устарела. Откройте меню заново.")
-            return
-        state_key = parts[1]
-        try:
-            page = int(parts[2])
-        except Exception:
-            client.send_message(to=user_id, text="❌ Команда устарела. Откройте меню заново.")
+def _admin_only(func: Callable) -> Callable:
+    """Пропускает в обработчик кнопки только администраторов."""
+    @functools.wraps(func)
+    def wrapper(client: WhatsApp, btn, user_id: str, data: str):
+        if not is_admin(user_id):
+            client.send_message(to=user_id, text="❌ Нет прав")
             return
-        
-        state = get_state(user_id)
-        
-        if state_key == "acts":
-            # Навигация по списку видов работ
-            kind = state["data"].get("acts_kind")
-            acts = state["data"].get("acts", [])
-            send_paginated_buttons(
-                client, user_id, "Выберите *вид работы*:",
-                items=acts,
-                make_button=lambda it: PaginationButton(title=it[1], callback_data=f"work:act:{kind}:{it[0]}"),
-                state_key="acts",
-                page=page,
-                back_cb="menu:work"
-            )
-        elif state_key == "locs":
-            # Навигация по списку локаций
-            lg = state["data"].get("locs_group")
-            locs = state["data"].get("locs", [])
-            send_paginated_buttons(
-                client, user_id, "Выберите *место*:",
-                items=locs,
-                make_button=lambda it: PaginationButton(title=it[1], callback_data=f"work:loc:{lg}:{it[0]}"),
-                state_key="locs",
-                page=page,
-                back_cb="menu:work"
-            )
-        elif state_key == "hours":
-            # Навигация по выбору часов
-            hours_opts = state["data"].get("hours_opts", [])
-            send_paginated_buttons(
-                client, user_id, "Выберите *кол-во часов*:",
-                items=hours_opts,
-                make_button=lambda h: PaginationButton(title=str(h), callback_data=f"work:hours:{h}"),
-                state_key="hours",
-                page=page,
-                back_cb="menu:work"
-            )
-        elif state_key == "edit_records":
-            # Навигация по редактору записей
-            st = get_state(user_id)
-            records = (st.get("data") or {}).get("edit_records") or []
-            if not records:
-                client.send_message(to=user_id, text="📝 Записей нет.")
-                u = get_user(user_id)
-                show_main_menu(client, user_id, u)
-                return
-            render_edit_records_page(client, user_id, records, page=page)
-        elif state_key == "edit_hours":
-            # Навигация по выбору часов при редактировании
-            rid = state["data"].get("edit_id")
-            work_d = state["data"].get("edit_date")
-            hours_opts = state["data"].get("edit_hours_opts", [])
-            send_paginated_buttons(
-                client, user_id, f"Укажите *новое количество часов* для записи #{rid} ({work_d}):",
-                items=hours_opts,
-                make_button=lambda h: PaginationButton(title=str(h), callback_data=f"edit:h:{h}"),
-                state_key="edit_hours",
-                page=page,
-                back_cb="menu:edit"
-            )
+        return func(client, btn, user_id, data)
+    return wrapper
+
+def _cb_nav(client: WhatsApp, btn, user_id: str, data: str):
+    # WA: Обработка навигации по страницам (для пагинации)
+    parts = data.split(":")
+    if len(parts) < 3:
+        client.send_message(to=user_id, text="❌ Команда устарела. Откройте меню заново.")
+        return
+    state_key = parts[1]
+    try:
+        page = int(parts[2])
+    except Exception:
+        client.send_message(to=user_id, text="❌ Команда устарела. Откройте меню заново.")
         return
     
-    if data == "menu:root":
-        u = get_user(user_id)
-        clear_state(user_id)
-        show_main_menu(client, user_id, u)
-    
-    elif data == "menu:more":
-        show_more_menu(client, user_id)
-    
-    elif data == "menu:work":
-        u = get_user(user_id)
-        if not u or not (u.get("full_name") or "").strip():
-            set_state(user_id, "waiting_name")
-            client.send_message(to=user_id, text="Введите *Фамилию Имя* для регистрации.")
-            return
-        set_state(user_id, "pick_work_group", {})
-        buttons = [
-            Button(title="Техника", callback_data="work:grp:tech"),
-            Button(title="Ручная", callback_data="work:grp:hand"),
-            Button(title="🔙 Назад", callback_data="menu:root"),
-        ]
-        client.send_message(to=user_id, text="Выберите *тип работы*:", buttons=buttons)
-    
-    elif data == "menu:stats":
-        buttons = [
-            Button(title="Сегодня", callback_data="stats:today"),
-            Button(title="Неделя", callback_data="stats:week"),
-            Button(title="🔙 Назад", callback_data="menu:root"),
-        ]
-        client.send_message(to=user_id, text="Выберите период статистики:", buttons=buttons)
-    
-    elif data == "menu:edit":
-        rows = user_recent_24h_reports(user_id)
-        if not rows:
-            client.send_message(to=user_id, text="📝 За последние 24 часа записей нет.")
-            return
-        
-        # WA: Показываем по 1 записи на странице с 2 кнопками действий (Править/Удалить)
-        # Сохраняем список записей в состояние для пагинации
-        state = get_state(user_id)
-        state["data"]["edit_records"] = rows
-        set_state(user_id, "viewing_edit", state["data"])
-        
-        render_edit_records_page(client, user_id, rows, page=0)
-    
-    elif data == "menu:name":
-        set_state(user_id, "waiting_name")
-        client.send_message(to=user_id, text="✏️ Введите *Фамилию Имя* для изменения (например: *Иванов Иван*):")
+    state = get_state(user_id)
     
-    elif data == "menu:admin":
-        if not is_admin(user_id):
-            client.send_message(to=user_id, text="❌ Нет прав")
-            return
-        
-        # WA: Максимум 3 кнопки - используем пагинацию или разбиваем на подменю
-        buttons = [
-            Button(title="➕➖ Работы", callback_data="adm:menu:activities"),
-            Button(title="➕➖ Локации", callback_data="adm:menu:locations"),
-            Button(title="📤 Экспорт", callback_data="adm:export"),
-        ]
-        client.send_message(to=user_id, text="⚙️ *Админ-панель*:", buttons=buttons)
-    
-    elif data == "adm:menu:activities":
-        if not is_admin(user_id):
-            client.send_message(to=user_id, text="❌ Нет прав")
-            return
-        buttons = [
-            Button(title="➕ Добавить работу", callback_data="adm:add:act"),
-            Button(title="➖ Удалить работу", callback_data="adm:del:act"),
-            Button(title="🔙 Админ", callback_data="menu:admin"),
-        ]
-        client.send_message(to=user_id, text="⚙️ *Управление работами*:", buttons=buttons)
-    
-    elif data == "adm:menu:locations":
-        if not is_admin(user_id):
-            client.send_message(to=user_id, text="❌ Нет прав")
-            return
-        buttons = [
-            Button(title="➕ Добавить локацию", callback_data="adm:add:loc"),
-            Button(title="➖ Удалить локацию", callback_data="adm:del:loc"),
-            Button(title="🔙 Админ", callback_data="menu:admin"),
-        ]
-        client.send_message(to=user_id, text="⚙️ *Управление локациями*:", buttons=buttons)
-    
-    elif data == "stats:today":
-        cmd_today(client, btn)
-    
-    elif data == "stats:week":
-        cmd_my(client, btn)
-    
-    elif data.startswith("work:grp:"):
-        kind = data.split(":")[2]
-        grp_name = GROUP_TECH if kind == "tech" else GROUP_HAND
-        state = get_state(user_id)
-        state["data"]["work"] = {"grp": grp_name}
-        set_state(user_id, "pick_activity", state["data"])
-        
-        # WA: Используем ID вместо названий в callback_data, применяем пагинацию
-        activities = list_activities_with_id(grp_name)
-        state["data"]["acts"] = activities
-        state["data"]["acts_kind"] = kind
-        set_state(user_id, "pick_activity", state["data"])
-        
+    if state_key == "acts":
+        # Навигация по списку видов работ
+        kind = state["data"].get("acts_kind")
+        acts = state["data"].get("acts", [])
         send_paginated_buttons(
             client, user_id, "Выберите *вид работы*:",
-            items=activities,
-            make_button=lambda it: PaginationButton(title=it[1], callback_data=f"work:act:{kind}:{it[0]}"),
+            items=acts,
+            callback_prefix=f"work:act:{kind}:",
             state_key="acts",
-            page=0,
+            page=page,
             back_cb="menu:work"
         )
-    
-    elif data.startswith("work:act:"):
-        # WA: Получаем название activity по ID из БД, а не из callback_data
-        try:
-            _, _, kind, act_id_str = data.split(":", 3)
-            act_id = int(act_id_str)
-        except Exception:
-            client.send_message(to=user_id, text="❌ Команда устарела или повреждена. Откройте меню заново.")
-            return
-        
-        result = get_activity_name(act_id)
-        if not result:
-            client.send_message(to=user_id, text="❌ Вид работы не найден. Начните заново.")
-            clear_state(user_id)
-            return
-        
-        activity_name, grp_name = result
-        
-        state = get_state(user_id)
-        work_data = state["data"].get("work", {})
-        work_data["grp"] = grp_name
-        work_data["activity"] = activity_name
-        state["data"]["work"] = work_data
-        set_state(user_id, "pick_loc_group", state["data"])
-        
-        # WA: Максимум 3 кнопки
-        buttons = [
-            Button(title="Поля", callback_data="work:locgrp:fields"),
-            Button(title="Склад", callback_data="work:locgrp:ware"),
-            Button(title="🔙 Назад", callback_data="menu:work"),
-        ]
-        client.send_message(to=user_id, text="Выберите *локацию*:", buttons=buttons)
-    
-    elif data.startswith("work:locgrp:"):
-        lg = data.split(":")[2]
-        grp = GROUP_FIELDS if lg == "fields" else GROUP_WARE
-        state = get_state(user_id)
-        work_data = state["data"].get("work", {})
-        work_data["loc_grp"] = grp
-        
-        if lg == "ware":
-            work_data["location"] = "Склад"
-            state["data"]["work"] = work_data
-            set_state(user_id, "pick_date", state["data"])
-            
-            # WA: Показываем даты с ограничением по кнопкам (максимум 2 даты + назад = 3)
-            today = date.today()
-            buttons = []
-            for i in range(2):  # WA: только 2 даты, чтобы влезла кнопка "Назад"
-                d = today - timedelta(days=i)
-                label = "Сегодня" if i == 0 else "Вчера"
-                buttons.append(Button(title=label, callback_data=f"work:date:{d.isoformat()}"))
-            buttons.append(Button(title="🔙 Назад", callback_data="menu:work"))
-            client.send_message(to=user_id, text="Выберите *дату*:", buttons=buttons[:3])
-        else:
-            state["data"]["work"] = work_data
-            set_state(user_id, "pick_location", state["data"])
-            
-            # WA: Используем ID вместо названий в callback_data, применяем пагинацию
-            locations = list_locations_with_id(GROUP_FIELDS)
-            state["data"]["locs"] = locations
-            state["data"]["locs_group"] = lg
-            set_state(user_id, "pick_location", state["data"])
-            
-            send_paginated_buttons(
-                client, user_id, "Выберите *место*:",
-                items=locations,
-                make_button=lambda it: PaginationButton(title=it[1], callback_data=f"work:loc:{lg}:{it[0]}"),
-                state_key="locs",
-                page=0,
-                back_cb="menu:work"
-            )
-    
-    elif data.startswith("work:loc:"):
-        # WA: Получаем название location по ID из БД, а не из callback_data
-        try:
-            _, _, lg, loc_id_str = data.split(":", 3)
-            loc_id = int(loc_id_str)
-        except Exception:
-            client.send_message(to=user_id, text="❌ Команда устарела или повреждена. Откройте меню заново.")
-            return
-        
-        result = get_location_name(loc_id)
-        if not result:
-            client.send_message(to=user_id, text="❌ Локация не найдена. Начните заново.")
-            clear_state(user_id)
+    elif state_key == "locs":
+        # Навигация по списку локаций
+        lg = state["data"].get("locs_group")
+        locs = state["data"].get("locs", [])
+        send_paginated_buttons(
+            client, user_id, "Выберите *место*:",
+            items=locs,
+            callback_prefix=f"work:loc:{lg}:",
+            state_key="locs",
+            page=page,
+            back_cb="menu:work"
+        )
+    elif state_key == "hours":
+        # Навигация по выбору часов
+        hours_opts = state["data"].get("hours_opts", [])
+        send_paginated_buttons(
+            client, user_id, "Выберите *кол-во часов*:",
+            items=hours_opts,
+            callback_prefix="work:hours:",
+            state_key="hours",
+            page=page,
+            back_cb="menu:work"
+        )
+    elif state_key == "edit_records":
+        # Навигация по редактору записей
+        window = state["data"].get("edit_window")
+        if not window or not window["count"]:
+            client.send_message(to=user_id, text="📝 Записей нет.")
+            u = get_user(user_id)
+            show_main_menu(client, user_id, u)
             return
-        
-        location_name, grp = result
-        
-        state = get_state(user_id)
-        work_data = state["data"].get("work", {})
-        work_data["loc_grp"] = grp
-        work_data["location"] = location_name
+        render_edit_records_page(client, user_id, window, page=page)
+    elif state_key == "edit_hours":
+        # Навигация по выбору часов при редактировании
+        rid = state["data"].get("edit_id")
+        work_d = state["data"].get("edit_date")
+        hours_opts = state["data"].get("edit_hours_opts", [])
+        send_paginated_buttons(
+            client, user_id, f"Укажите *новое количество часов* для записи #{rid} ({work_d}):",
+            items=hours_opts,
+            callback_prefix="edit:h:",
+            state_key="edit_hours",
+            page=page,
+            back_cb="menu:edit"
+        )
+
+def _cb_menu_root(client: WhatsApp, btn, user_id: str, data: str):
+    u = get_user(user_id)
+    clear_state(user_id)
+    show_main_menu(client, user_id, u)
+
+def _cb_menu_more(client: WhatsApp, btn, user_id: str, data: str):
+    show_more_menu(client, user_id)
+
+def _cb_menu_work(client: WhatsApp, btn, user_id: str, data: str):
+    u = get_user(user_id)
+    if not u or not (u.get("full_name") or "").strip():
+        set_state(user_id, "waiting_name")
+        client.send_message(to=user_id, text="Введите *Фамилию Имя* для регистрации.")
+        return
+    set_state(user_id, "pick_work_group", {})
+    buttons = [
+        Button(title="Техника", callback_data="work:grp:tech"),
+        Button(title="Ручная", callback_data="work:grp:hand"),
+        Button(title="🔙 Назад", callback_data="menu:root"),
+    ]
+    client.send_message(to=user_id, text="Выберите *тип работы*:", buttons=buttons)
+
+def _cb_menu_stats(client: WhatsApp, btn, user_id: str, data: str):
+    buttons = [
+        Button(title="Сегодня", callback_data="stats:today"),
+        Button(title="Неделя", callback_data="stats:week"),
+        Button(title="🔙 Назад", callback_data="menu:root"),
+    ]
+    client.send_message(to=user_id, text="Выберите период статистики:", buttons=buttons)
+
+def _cb_menu_edit(client: WhatsApp, btn, user_id: str, data: str):
+    window = open_edit_window(user_id)
+    if not window["count"]:
+        client.send_message(to=user_id, text="📝 За последние 24 часа записей нет.")
+        return
+    
+    # WA: Показываем по 1 записи на странице с 2 кнопками действий (Править/Удалить)
+    # Для пагинации в состоянии хранится только окно записей
+    state = get_state(user_id)
+    state["data"]["edit_window"] = window
+    set_state(user_id, "viewing_edit", state["data"])
+    
+    render_edit_records_page(client, user_id, window, page=0)
+
+def _cb_menu_name(client: WhatsApp, btn, user_id: str, data: str):
+    set_state(user_id, "waiting_name")
+    client.send_message(to=user_id, text="✏️ Введите *Фамилию Имя* для изменения (например: *Иванов Иван*):")
+
+@_admin_only
+def _cb_menu_admin(client: WhatsApp, btn, user_id: str, data: str):
+    # WA: Максимум 3 кнопки - используем пагинацию или разбиваем на подменю
+    buttons = [
+        Button(title="➕➖ Работы", callback_data="adm:menu:activities"),
+        Button(title="➕➖ Локации", callback_data="adm:menu:locations"),
+        Button(title="📤 Экспорт", callback_data="adm:export"),
+    ]
+    client.send_message(to=user_id, text="⚙️ *Админ-панель*:", buttons=buttons)
+
+@_admin_only
+def _cb_adm_menu_activities(client: WhatsApp, btn, user_id: str, data: str):
+    buttons = [
+        Button(title="➕ Добавить работу", callback_data="adm:add:act"),
+        Button(title="➖ Удалить работу", callback_data="adm:del:act"),
+        Button(title="🔙 Админ", callback_data="menu:admin"),
+    ]
+    client.send_message(to=user_id, text="⚙️ *Управление работами*:", buttons=buttons)
+
+@_admin_only
+def _cb_adm_menu_locations(client: WhatsApp, btn, user_id: str, data: str):
+    buttons = [
+        Button(title="➕ Добавить локацию", callback_data="adm:add:loc"),
+        Button(title="➖ Удалить локацию", callback_data="adm:del:loc"),
+        Button(title="🔙 Админ", callback_data="menu:admin"),
+    ]
+    client.send_message(to=user_id, text="⚙️ *Управление локациями*:", buttons=buttons)
+
+def _cb_stats_today(client: WhatsApp, btn, user_id: str, data: str):
+    cmd_today(client, btn)
+
+def _cb_stats_week(client: WhatsApp, btn, user_id: str, data: str):
+    cmd_my(client, btn)
+
+def _cb_work_grp(client: WhatsApp, btn, user_id: str, data: str):
+    kind = data.split(":")[2]
+    grp_name = GROUP_TECH if kind == "tech" else GROUP_HAND
+    state = get_state(user_id)
+    state["data"]["work"] = {"grp": grp_name}
+    
+    # WA: Используем ID вместо названий в callback_data, применяем пагинацию
+    activities = list_activities_with_id(grp_name)
+    state["data"]["acts"] = activities
+    state["data"]["acts_kind"] = kind
+    set_state(user_id, "pick_activity", state["data"])
+    
+    send_paginated_buttons(
+        client, user_id, "Выберите *вид работы*:",
+        items=activities,
+        callback_prefix=f"work:act:{kind}:",
+        state_key="acts",
+        page=0,
+        back_cb="menu:work"
+    )
+
+def _cb_work_act(client: WhatsApp, btn, user_id: str, data: str):
+    # WA: Получаем название activity по ID из БД, а не из callback_data
+    try:
+        _, _, kind, act_id_str = data.split(":", 3)
+        act_id = int(act_id_str)
+    except Exception:
+        client.send_message(to=user_id, text="❌ Команда устарела или повреждена. Откройте меню заново.")
+        return
+    
+    result = get_activity_name(act_id)
+    if not result:
+        client.send_message(to=user_id, text="❌ Вид работы не найден. Начните заново.")
+        clear_state(user_id)
+        return
+    
+    activity_name, grp_name = result
+    
+    state = get_state(user_id)
+    work_data = state["data"].get("work", {})
+    work_data["grp"] = grp_name
+    work_data["activity"] = activity_name
+    state["data"]["work"] = work_data
+    set_state(user_id, "pick_loc_group", state["data"])
+    
+    # WA: Максимум 3 кнопки
+    buttons = [
+        Button(title="Поля", callback_data="work:locgrp:fields"),
+        Button(title="Склад", callback_data="work:locgrp:ware"),
+        Button(title="🔙 Назад", callback_data="menu:work"),
+    ]
+    client.send_message(to=user_id, text="Выберите *локацию*:", buttons=buttons)
+
+def _cb_work_locgrp(client: WhatsApp, btn, user_id: str, data: str):
+    lg = data.split(":")[2]
+    grp = GROUP_FIELDS if lg == "fields" else GROUP_WARE
+    state = get_state(user_id)
+    work_data = state["data"].get("work", {})
+    work_data["loc_grp"] = grp
+    
+    if lg == "ware":
+        work_data["location"] = "Склад"
         state["data"]["work"] = work_data
         set_state(user_id, "pick_date", state["data"])
         
@@ -1244,300 +1667,404 @@ def handle_callback(client: WhatsApp, btn):
             buttons.append(Button(title=label, callback_data=f"work:date:{d.isoformat()}"))
         buttons.append(Button(title="🔙 Назад", callback_data="menu:work"))
         client.send_message(to=user_id, text="Выберите *дату*:", buttons=buttons[:3])
-    
-    elif data.startswith("work:date:"):
-        try:
-            d = data.split(":")[2]
-        except Exception:
-            client.send_message(to=user_id, text="❌ Команда устарела или повреждена. Откройте меню заново.")
-            return
-        
-        state = get_state(user_id)
-        work_data = state["data"].get("work", {})
-        work_data["work_date"] = d
+    else:
         state["data"]["work"] = work_data
-        set_state(user_id, "pick_hours", state["data"])
         
-        # WA: Используем пагинацию для выбора часов (максимум 3 кнопки)
-        hours_options = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 12, 16, 20, 24]
-        state["data"]["hours_opts"] = hours_options
-        set_state(user_id, "pick_hours", state["data"])
+        # WA: Используем ID вместо названий в callback_data, применяем пагинацию
+        locations = list_locations_with_id(GROUP_FIELDS)
+        state["data"]["locs"] = locations
+        state["data"]["locs_group"] = lg
+        set_state(user_id, "pick_location", state["data"])
         
         send_paginated_buttons(
-            client, user_id, "Выберите *кол-во часов*:",
-            items=hours_options,
-            make_button=lambda h: PaginationButton(title=str(h), callback_data=f"work:hours:{h}"),
-            state_key="hours",
+            client, user_id, "Выберите *место*:",
+            items=locations,
+            callback_prefix=f"work:loc:{lg}:",
+            state_key="locs",
             page=0,
             back_cb="menu:work"
         )
+
+def _cb_work_loc(client: WhatsApp, btn, user_id: str, data: str):
+    # WA: Получаем название location по ID из БД, а не из callback_data
+    try:
+        _, _, lg, loc_id_str = data.split(":", 3)
+        loc_id = int(loc_id_str)
+    except Exception:
+        client.send_message(to=user_id, text="❌ Команда устарела или повреждена. Откройте меню заново.")
+        return
     
-    elif data.startswith("work:hours:"):
-        try:
-            hours = int(data.split(":")[2])
-        except Exception:
-            client.send_message(to=user_id, text="❌ Команда устарела или повреждена. Откройте меню заново.")
-            return
-        
-        state = get_state(user_id)
-        work_data = state["data"].get("work", {})
-        
-        if not all(k in work_data for k in ("grp", "activity", "loc_grp", "location", "work_date")):
-            client.send_message(to=user_id, text="Что-то пошло не так. Начните заново.")
-            clear_state(user_id)
-            return
-        
-        # Улучшенная валидация с подробным сообщением об ошибке
-        already = sum_hours_for_user_date(user_id, work_data["work_date"])
-        if already + hours > 24:
-            max_can_add = 24 - already
-            error_msg = (
-                f"❗ *Превышен лимит часов*\n\n"
-                f"Сейчас учтено: *{already}* ч\n"
-                f"Попытка добавить: *{hours}* ч\n"
-                f"Максимум в сутки: *24* ч\n\n"
-                f"Вы можете добавить не более *{max_can_add}* ч."
-            )
-            client.send_message(to=user_id, text=error_msg)
-            return
-        
-        u = get_user(user_id)
-        rid = insert_report(
-            user_id=user_id,
-            reg_name=(u.get("full_name") or ""),
-            location=work_data["location"],
-            loc_grp=work_data["loc_grp"],
-            activity=work_data["activity"],
-            act_grp=work_data["grp"],
-            work_date=work_data["work_date"],
-            hours=hours
-        )
-        
-        text = (
-            f"✅ *Сохранено*\n\n"
-            f"Дата: *{work_data['work_date']}*\n"
-            f"Место: *{work_data['location']}*\n"
-            f"Работа: *{work_data['activity']}*\n"
-            f"Часы: *{hours}*\n"
-            f"ID записи: `#{rid}`"
-        )
+    result = get_location_name(loc_id)
+    if not result:
+        client.send_message(to=user_id, text="❌ Локация не найдена. Начните заново.")
         clear_state(user_id)
-        client.send_message(to=user_id, text=text)
-        show_main_menu(client, user_id, u)
+        return
     
-    elif data.startswith("edit:del:"):
-        try:
-            rid = int(data.split(":")[2])
-        except Exception:
-            client.send_message(to=user_id, text="❌ Не удалось разобрать команду.")
-            return
-
-        ok = delete_report(rid, user_id)
-        st = get_state(user_id)
-        records = [r for r in st["data"].get("edit_records", []) if r[0] != rid]
-        st["data"]["edit_records"] = records
+    location_name, grp = result
+    
+    state = get_state(user_id)
+    work_data = state["data"].get("work", {})
+    work_data["loc_grp"] = grp
+    work_data["location"] = location_name
+    state["data"]["work"] = work_data
+    set_state(user_id, "pick_date", state["data"])
+    
+    # WA: Показываем даты с ограничением по кнопкам (максимум 2 даты + назад = 3)
+    today = date.today()
+    buttons = []
+    for i in range(2):  # WA: только 2 даты, чтобы влезла кнопка "Назад"
+        d = today - timedelta(days=i)
+        label = "Сегодня" if i == 0 else "Вчера"
+        buttons.append(Button(title=label, callback_data=f"work:date:{d.isoformat()}"))
+    buttons.append(Button(title="🔙 Назад", callback_data="menu:work"))
+    client.send_message(to=user_id, text="Выберите *дату*:", buttons=buttons[:3])
+
+def _cb_work_date(client: WhatsApp, btn, user_id: str, data: str):
+    try:
+        d = data.split(":")[2]
+    except Exception:
+        client.send_message(to=user_id, text="❌ Команда устарела или повреждена. Откройте меню заново.")
+        return
+    
+    state = get_state(user_id)
+    work_data = state["data"].get("work", {})
+    work_data["work_date"] = d
+    state["data"]["work"] = work_data
+    
+    # WA: Используем пагинацию для выбора часов (максимум 3 кнопки)
+    hours_options = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 12, 16, 20, 24]
+    state["data"]["hours_opts"] = hours_options
+    set_state(user_id, "pick_hours", state["data"])
+    
+    send_paginated_buttons(
+        client, user_id, "Выберите *кол-во часов*:",
+        items=hours_options,
+        callback_prefix="work:hours:",
+        state_key="hours",
+        page=0,
+        back_cb="menu:work"
+    )
 
-        if ok and records:
-            # возвращаемся к первой странице или сохраняем текущую, если храните индекс
-            render_edit_records_page(client, user_id, records, page=0)
-        elif ok:
-            client.send_message(to=user_id, text="✅ Удалено\n\n📝 Записей нет.")
-        else:
-            client.send_message(to=user_id, text="❌ Не получилось удалить")
+def _cb_work_hours(client: WhatsApp, btn, user_id: str, data: str):
+    try:
+        hours = int(data.split(":")[2])
+    except Exception:
+        client.send_message(to=user_id, text="❌ Команда устарела или повреждена. Откройте меню заново.")
         return
     
-    elif data.startswith("edit:chg:"):
-        try:
-            _, _, rid, work_d = data.split(":", 3)
-            rid = int(rid)
-        except Exception:
-            client.send_message(to=user_id, text="❌ Команда устарела или повреждена. Откройте меню заново.")
-            return
-        
-        # WA: Используем пагинацию для выбора часов (максимум 3 кнопки)
-        hours_options = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 12, 16, 20, 24]
-        state = get_state(user_id)
-        state["data"]["edit_id"] = rid
-        state["data"]["edit_date"] = work_d
-        state["data"]["edit_hours_opts"] = hours_options
-        set_state(user_id, "edit_hours", state["data"])
-        
-        send_paginated_buttons(
-            client, user_id, f"Укажите *новое количество часов* для записи #{rid} ({work_d}):",
-            items=hours_options,
-            make_button=lambda h: PaginationButton(title=str(h), callback_data=f"edit:h:{h}"),
-            state_key="edit_hours",
-            page=0,
-            back_cb="menu:edit"
+    state = get_state(user_id)
+    work_data = state["data"].get("work", {})
+    
+    if not all(k in work_data for k in ("grp", "activity", "loc_grp", "location", "work_date")):
+        client.send_message(to=user_id, text="Что-то пошло не так. Начните заново.")
+        clear_state(user_id)
+        return
+    
+    # Улучшенная валидация с подробным сообщением об ошибке
+    already = sum_hours_for_user_date(user_id, work_data["work_date"])
+    if already + hours > 24:
+        max_can_add = 24 - already
+        error_msg = (
+            f"❗ *Превышен лимит часов*\n\n"
+            f"Сейчас учтено: *{already}* ч\n"
+            f"Попытка добавить: *{hours}* ч\n"
+            f"Максимум в сутки: *24* ч\n\n"
+            f"Вы можете добавить не более *{max_can_add}* ч."
         )
+        client.send_message(to=user_id, text=error_msg)
+        return
     
-    elif data.startswith("edit:h:"):
-        try:
-            new_h = int(data.split(":")[2])
-        except Exception:
-            client.send_message(to=user_id, text="❌ Команда устарела или повреждена. Откройте меню заново.")
-            return
-        
-        state = get_state(user_id)
-        try:
-            rid = int(state["data"].get("edit_id"))
-            work_d = state["data"].get("edit_date")
-        except Exception:
-            client.send_message(to=user_id, text="❌ Данные сессии устарели. Откройте меню заново.")
-            return
-        
-        # Улучшенная валидация с подробным сообщением об ошибке
-        already = sum_hours_for_user_date(user_id, work_d, exclude_report_id=rid)
-        if already + new_h > 24:
-            max_can_add = 24 - already
-            error_msg = (
-                f"❗ *Превышен лимит часов*\n\n"
-                f"Сейчас учтено (без этой записи): *{already}* ч\n"
-                f"Попытка установить: *{new_h}* ч\n"
-                f"Максимум в сутки: *24* ч\n\n"
-                f"Вы можете установить не более *{max_can_add}* ч."
-            )
-            client.send_message(to=user_id, text=error_msg)
-            return
-        
-        ok = update_report_hours(rid, user_id, new_h)
-        if ok:
-            clear_state(user_id)
-            rows = user_recent_24h_reports(user_id)
-            if rows:
-                st = get_state(user_id)
-                st["data"]["edit_records"] = rows
-                set_state(user_id, "viewing_edit", st["data"])
-                client.send_message(to=user_id, text="✅ Обновлено")
-                render_edit_records_page(client, user_id, rows, page=0)
-            else:
-                client.send_message(to=user_id, text="✅ Обновлено\n\n📝 Записей нет.")
-        else:
-            client.send_message(to=user_id, text="❌ Не получилось обновить")
+    u = get_user(user_id)
+    rid = insert_report(
+        user_id=user_id,
+        reg_name=(u.get("full_name") or ""),
+        location=work_data["location"],
+        loc_grp=work_data["loc_grp"],
+        activity=work_data["activity"],
+        act_grp=work_data["grp"],
+        work_date=work_data["work_date"],
+        hours=hours
+    )
     
-    elif data == "adm:add:act":
-        if not is_admin(user_id):
-            client.send_message(to=user_id, text="❌ Нет прав")
-            return
-        set_state(user_id, "adm_wait_act_add")
-        client.send_message(to=user_id, text="Введите название *работы* для добавления:")
+    text = (
+        f"✅ *Сохранено*\n\n"
+        f"Дата: *{work_data['work_date']}*\n"
+        f"Место: *{work_data['location']}*\n"
+        f"Работа: *{work_data['activity']}*\n"
+        f"Часы: *{hours}*\n"
+        f"ID записи: `#{rid}`"
+    )
+    clear_state(user_id)
+    client.send_message(to=user_id, text=text)
+    show_main_menu(client, user_id, u)
 
-    elif data == "adm:del:act":
-        if not is_admin(user_id):
-            client.send_message(to=user_id, text="❌ Нет прав")
-            return
-        set_state(user_id, "adm_wait_act_del")
-        client.send_message(to=user_id, text="Введите точное название *работы* для удаления:")
+def _cb_edit_del(client: WhatsApp, btn, user_id: str, data: str):
+    try:
+        rid = int(data.split(":")[2])
+    except Exception:
+        client.send_message(to=user_id, text="❌ Не удалось разобрать команду.")
+        return
 
-    elif data == "adm:add:loc":
-        if not is_admin(user_id):
-            client.send_message(to=user_id, text="❌ Нет прав")
-            return
-        set_state(user_id, "adm_wait_loc_add")
-        client.send_message(to=user_id, text="Введите название *локации* для добавления:")
+    ok = delete_report(rid, user_id)
+    st = get_state(user_id)
+    window = st["data"].get("edit_window")
+    if ok and window:
+        window["count"] = count_edit_window(user_id, window)
+
+    if ok and window and window["count"]:
+        # возвращаемся к первой странице или сохраняем текущую, если храните индекс
+        render_edit_records_page(client, user_id, window, page=0, header_text="✅ Удалено")
+    elif ok:
+        client.send_message(to=user_id, text="✅ Удалено\n\n📝 Записей нет.")
+    else:
+        client.send_message(to=user_id, text="❌ Не получилось удалить")
 
-    elif data == "adm:del:loc":
-        if not is_admin(user_id):
-            client.send_message(to=user_id, text="❌ Нет прав")
-            return
-        set_state(user_id, "adm_wait_loc_del")
-        client.send_message(to=user_id, text="Введите точное название *локации* для удаления:")
+def _cb_edit_chg(client: WhatsApp, btn, user_id: str, data: str):
+    try:
+        _, _, rid, work_d = data.split(":", 3)
+        rid = int(rid)
+    except Exception:
+        client.send_message(to=user_id, text="❌ Команда устарела или повреждена. Откройте меню заново.")
+        return
+    
+    # WA: Используем пагинацию для выбора часов (максимум 3 кнопки)
+    hours_options = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 12, 16, 20, 24]
+    state = get_state(user_id)
+    state["data"]["edit_id"] = rid
+    state["data"]["edit_date"] = work_d
+    state["data"]["edit_hours_opts"] = hours_options
+    set_state(user_id, "edit_hours", state["data"])
+    
+    send_paginated_buttons(
+        client, user_id, f"Укажите *новое количество часов* для записи #{rid} ({work_d}):",
+        items=hours_options,
+        callback_prefix="edit:h:",
+        state_key="edit_hours",
+        page=0,
+        back_cb="menu:edit"
+    )
 
-    elif data == "adm:export":
-        if not is_admin(user_id):
-            client.send_message(to=user_id, text="❌ Нет прав")
-            return
-        
-        client.send_message(to=user_id, text="⏳ Экспортирую отчеты в Google Sheets...")
-        try:
+def _cb_edit_h(client: WhatsApp, btn, user_id: str, data: str):
+    try:
+        new_h = int(data.split(":")[2])
+    except Exception:
+        client.send_message(to=user_id, text="❌ Команда устарела или повреждена. Откройте меню заново.")
+        return
+    
+    state = get_state(user_id)
+    try:
+        rid = int(state["data"].get("edit_id"))
+        work_d = state["data"].get("edit_date")
+    except Exception:
+        client.send_message(to=user_id, text="❌ Данные сессии устарели. Откройте меню заново.")
+        return
+    
+    # Улучшенная валидация с подробным сообщением об ошибке
+    already = sum_hours_for_user_date(user_id, work_d, exclude_report_id=rid)
+    if already + new_h > 24:
+        max_can_add = 24 - already
+        error_msg = (
+            f"❗ *Превышен лимит часов*\n\n"
+            f"Сейчас учтено (без этой записи): *{already}* ч\n"
+            f"Попытка установить: *{new_h}* ч\n"
+            f"Максимум в сутки: *24* ч\n\n"
+            f"Вы можете установить не более *{max_can_add}* ч."
+        )
+        client.send_message(to=user_id, text=error_msg)
+        return
+    
+    ok = update_report_hours(rid, user_id, new_h)
+    if ok:
+        # Число записей в окне не меняется - окно берём из состояния,
+        # заново открываем, только если состояние потерялось
+        window = state["data"].get("edit_window") or open_edit_window(user_id)
+        clear_state(user_id)
+        if window["count"]:
+            set_state(user_id, "viewing_edit", {"edit_window": window})
+            render_edit_records_page(client, user_id, window, page=0, header_text="✅ Обновлено")
+        else:
+            client.send_message(to=user_id, text="✅ Обновлено\n\n📝 Записей нет.")
+    else:
+        client.send_message(to=user_id, text="❌ Не получилось обновить")
+
+@_admin_only
+def _cb_adm_add_act(client: WhatsApp, btn, user_id: str, data: str):
+    set_state(user_id, "adm_wait_act_add")
+    client.send_message(to=user_id, text="Введите название *работы* для добавления:")
+
+@_admin_only
+def _cb_adm_del_act(client: WhatsApp, btn, user_id: str, data: str):
+    set_state(user_id, "adm_wait_act_del")
+    client.send_message(to=user_id, text="Введите точное название *работы* для удаления:")
+
+@_admin_only
+def _cb_adm_add_loc(client: WhatsApp, btn, user_id: str, data: str):
+    set_state(user_id, "adm_wait_loc_add")
+    client.send_message(to=user_id, text="Введите название *локации* для добавления:")
+
+@_admin_only
+def _cb_adm_del_loc(client: WhatsApp, btn, user_id: str, data: str):
+    set_state(user_id, "adm_wait_loc_del")
+    client.send_message(to=user_id, text="Введите точное название *локации* для удаления:")
+
+@_admin_only
+def _cb_adm_export(client: WhatsApp, btn, user_id: str, data: str):
+    # Экспорт занимает секунды (Google API) - выполняем в отдельном потоке,
+    # чтобы не задерживать другие апдейты этого исполнителя
+    client.send_message(to=user_id, text="⏳ Экспорт запущен, пришлю результат...")
+    _export_pool.submit(_do_export_and_notify, client, user_id)
+
+def _do_export_and_notify(client: WhatsApp, user_id: str):
+    try:
+        with _export_lock:
             count, message = export_reports_to_sheets()
             text = f"✅ {message}" if count > 0 else f"ℹ️ {message}"
             created, sheet_msg = check_and_create_next_month_sheet()
-            if created:
-                text += f"\n\n📅 {sheet_msg}"
-        except Exception as e:
-            logging.error(f"Export error: {e}")
-            text = f"❌ Ошибка экспорта: {str(e)}"
-        
-        client.send_message(to=user_id, text=text)
+        if created:
+            text += f"\n\n📅 {sheet_msg}"
+    except Exception as e:
+        logging.error(f"Export error: {e}")
+        text = f"❌ Ошибка экспорта: {str(e)}"
+    
+    client.send_message(to=user_id, text=text)
+
+# Точные callback_data
+_CALLBACK_EXACT = {
+    "menu:root": _cb_menu_root,
+    "menu:more": _cb_menu_more,
+    "menu:work": _cb_menu_work,
+    "menu:stats": _cb_menu_stats,
+    "menu:edit": _cb_menu_edit,
+    "menu:name": _cb_menu_name,
+    "menu:admin": _cb_menu_admin,
+    "adm:menu:activities": _cb_adm_menu_activities,
+    "adm:menu:locations": _cb_adm_menu_locations,
+    "stats:today": _cb_stats_today,
+    "stats:week": _cb_stats_week,
+    "adm:add:act": _cb_adm_add_act,
+    "adm:del:act": _cb_adm_del_act,
+    "adm:add:loc": _cb_adm_add_loc,
+    "adm:del:loc": _cb_adm_del_loc,
+    "adm:export": _cb_adm_export,
+}
+
+# Префиксы callback_data с параметрами ("work:act:<kind>:<id>" и т.п.)
+_CALLBACK_PREFIX = {
+    "nav:": _cb_nav,
+    "work:grp:": _cb_work_grp,
+    "work:act:": _cb_work_act,
+    "work:locgrp:": _cb_work_locgrp,
+    "work:loc:": _cb_work_loc,
+    "work:date:": _cb_work_date,
+    "work:hours:": _cb_work_hours,
+    "edit:del:": _cb_edit_del,
+    "edit:chg:": _cb_edit_chg,
+    "edit:h:": _cb_edit_h,
+}
+
+def _route_callback(data: str) -> Optional[Callable]:
+    """Находит обработчик кнопки: сначала точное совпадение, затем префикс
+    из одного ("nav:") или двух ("work:grp:") сегментов."""
+    handler = _CALLBACK_EXACT.get(data)
+    if handler:
+        return handler
+    head, sep, rest = data.partition(":")
+    if not sep:
+        return None
+    handler = _CALLBACK_PREFIX.get(f"{head}:")
+    if handler:
+        return handler
+    sub, sep, _ = rest.partition(":")
+    return _CALLBACK_PREFIX.get(f"{head}:{sub}:") if sep else None
+
+@wa.on_callback_button()
+@in_background
+def handle_callback(client: WhatsApp, btn):
+    user_id = btn.from_user.wa_id
+    data = btn.data
+    handler = _route_callback(data)
+    if handler:
+        handler(client, btn, user_id, data)
 
 # -----------------------------
 # Обработка текстовых сообщений (FSM)
 # -----------------------------
 
-@wa.on_message(text)
-def handle_text(client: WhatsApp, msg: WAMessage):
-    user_id = msg.from_user.wa_id
-    message_text = (msg.text or "").strip()
-    logging.info(f"[TEXT] {user_id}: {message_text}")
-    normalized = message_text.lower()
-
-    if normalized in {"start", "старт"}:
-        cmd_start(client, msg)
-        return
-    if normalized in {"menu", "меню"}:
-        cmd_menu(client, msg)
+# Текстовые команды: одна проверка по словарю вместо цепочки if
+_TEXT_COMMANDS = {
+    **dict.fromkeys(("start", "старт"), cmd_start),
+    **dict.fromkeys(("menu", "меню"), cmd_menu),
+    **dict.fromkeys(("today", "сегодня"), cmd_today),
+    **dict.fromkeys(("my", "мои"), cmd_my),
+}
+# Длиннее самой длинной команды текст командой быть не может - lower() не нужен
+_TEXT_COMMAND_MAX_LEN = max(map(len, _TEXT_COMMANDS))
+
+def _text_waiting_name(client: WhatsApp, msg: WAMessage, user_id: str, message_text: str):
+    if len(message_text) < 3 or " " not in message_text:
+        client.send_message(to=user_id, text="Введите Фамилию и Имя (через пробел). Пример: *Иванов Иван*")
         return
-    if normalized in {"today", "сегодня"}:
-        cmd_today(client, msg)
-        return
-    if normalized in {"my", "мои"}:
-        cmd_my(client, msg)
-        return
-
-    state = get_state(user_id)
-    current_state = state.get("state")
     
-    if current_state == "waiting_name":
-        if len(message_text) < 3 or " " not in message_text:
-            client.send_message(to=user_id, text="Введите Фамилию и Имя (через пробел). Пример: *Иванов Иван*")
-            return
-        
-        old_user = get_user(user_id)
-        is_new_user = not old_user or not (old_user.get("full_name") or "").strip()
-        
-        upsert_user(user_id, message_text, TZ)
-        u = get_user(user_id)
-        clear_state(user_id)
-        
-        if is_new_user:
-            client.send_message(to=user_id, text=f"✅ Зарегистрировано как: *{message_text}*")
-        else:
-            client.send_message(to=user_id, text=f"✏️ Имя изменено на: *{message_text}*")
-        
-        show_main_menu(client, user_id, u)
+    old_user = get_user(user_id)
+    is_new_user = not old_user or not (old_user.get("full_name") or "").strip()
     
-    elif current_state == "adm_wait_act_add":
-        ok = add_activity(GROUP_HAND, message_text)  # добавляем в группу "ручная"
-        clear_state(user_id)
-        client.send_message(to=user_id, text="✅ Добавлено" if ok else "⚠️ Уже существует")
-        return
+    upsert_user(user_id, message_text, TZ)
+    u = get_user(user_id)
+    clear_state(user_id)
+    
+    if is_new_user:
+        client.send_message(to=user_id, text=f"✅ Зарегистрировано как: *{message_text}*")
+    else:
+        client.send_message(to=user_id, text=f"✏️ Имя изменено на: *{message_text}*")
+    
+    show_main_menu(client, user_id, u)
 
-    elif current_state == "adm_wait_act_del":
-        ok = remove_activity(message_text)
+def _catalog_text_handler(action: Callable[[str], bool], ok_text: str, fail_text: str) -> Callable:
+    """Обработчик ввода админа: действие со справочником, сброс состояния, ответ."""
+    def handler(client: WhatsApp, msg: WAMessage, user_id: str, message_text: str):
+        ok = action(message_text)
         clear_state(user_id)
-        client.send_message(to=user_id, text="✅ Удалено" if ok else "❌ Не найдено")
-        return
+        client.send_message(to=user_id, text=ok_text if ok else fail_text)
+    return handler
 
-    elif current_state == "adm_wait_loc_add":
-        ok = add_location(GROUP_FIELDS, message_text)  # добавляем в группу "поля"
-        clear_state(user_id)
-        client.send_message(to=user_id, text="✅ Добавлено" if ok else "⚠️ Уже существует")
-        return
+def _text_default(client: WhatsApp, msg: WAMessage, user_id: str, message_text: str):
+    # Дефолтное поведение - показать меню
+    u = get_user(user_id)
+    if u:
+        show_main_menu(client, user_id, u)
+    else:
+        cmd_start(client, msg)
 
-    elif current_state == "adm_wait_loc_del":
-        ok = remove_location(message_text)
-        clear_state(user_id)
-        client.send_message(to=user_id, text="✅ Удалено" if ok else "❌ Не найдено")
+# Обработчики свободного текста по текущему состоянию FSM
+_TEXT_STATE_HANDLERS = {
+    "waiting_name": _text_waiting_name,
+    # добавляем в группу "ручная"
+    "adm_wait_act_add": _catalog_text_handler(
+        lambda name: add_activity(GROUP_HAND, name), "✅ Добавлено", "⚠️ Уже существует"),
+    "adm_wait_act_del": _catalog_text_handler(remove_activity, "✅ Удалено", "❌ Не найдено"),
+    # добавляем в группу "поля"
+    "adm_wait_loc_add": _catalog_text_handler(
+        lambda name: add_location(GROUP_FIELDS, name), "✅ Добавлено", "⚠️ Уже существует"),
+    "adm_wait_loc_del": _catalog_text_handler(remove_location, "✅ Удалено", "❌ Не найдено"),
+}
+
+@wa.on_message(text)
+@in_background
+def handle_text(client: WhatsApp, msg: WAMessage):
+    user_id = msg.from_user.wa_id
+    message_text = (msg.text or "").strip()
+    # Текст сообщения - только в DEBUG, форматируется лишь при включённом уровне
+    logging.debug("[TEXT] %s: %s", user_id, message_text)
+
+    command = (_TEXT_COMMANDS.get(message_text.lower())
+               if len(message_text) <= _TEXT_COMMAND_MAX_LEN else None)
+    if command:
+        command(client, msg)
         return
-    
-    else:
-        # Дефолтное поведение - показать меню
-        u = get_user(user_id)
-        if u:
-            show_main_menu(client, user_id, u)
-        else:
-            cmd_start(client, msg)
+
+    current_state = get_state(user_id).get("state")
+    handler = _TEXT_STATE_HANDLERS.get(current_state, _text_default)
+    handler(client, msg, user_id, message_text)
 
 # -----------------------------
 # Автоматический экспорт
@@ -1546,43 +2073,56 @@ def handle_text(client: WhatsApp, msg: WAMessage):
 def scheduled_export():
     try:
         logging.info("Running scheduled export...")
-        count, message = export_reports_to_sheets()
-        logging.info(f"Scheduled export result: {message}")
-        
-        created, sheet_msg = check_and_create_next_month_sheet()
+        with _export_lock:
+            count, message = export_reports_to_sheets()
+            logging.info(f"Scheduled export result: {message}")
+            
+            created, sheet_msg = check_and_create_next_month_sheet()
         if created:
             logging.info(sheet_msg)
     except Exception as e:
         logging.error(f"Scheduled export error: {e}")
 
+def start_scheduler() -> Optional[BackgroundScheduler]:
+    """Запускает плановый экспорт (AUTO_EXPORT_CRON), если он включён."""
+    if not AUTO_EXPORT_ENABLED:
+        return None
+    
+    cron_parts = AUTO_EXPORT_CRON.split()
+    if len(cron_parts) != 5:
+        logging.warning(f"Invalid cron expression: {AUTO_EXPORT_CRON}")
+        return None
+    
+    # Одна cron-задача: одного потока исполнителя достаточно (по умолчанию 10).
+    # Пропущенные запуски схлопываются в один, параллельных экспортов нет
+    scheduler = BackgroundScheduler(
+        timezone=TZ,
+        executors={"default": SchedulerThreadPool(1)},
+        job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": 3600},
+    )
+    minute, hour, day, month, day_of_week = cron_parts
+    trigger = CronTrigger(
+        minute=minute,
+        hour=hour,
+        day=day,
+        month=month,
+        day_of_week=day_of_week
+    )
+    scheduler.add_job(scheduled_export, trigger)
+    scheduler.start()
+    logging.info(f"Scheduled export enabled: {AUTO_EXPORT_CRON}")
+    return scheduler
+
 # -----------------------------
 # Запуск
 # -----------------------------
 
+# Разработка: python bot_polya_whatsapp.py
+# Продакшен: gunicorn -c gunicorn_polya.conf.py bot_polya_whatsapp:app
 if __name__ == "__main__":
     init_db()
-    
-    # Настройка автоматического экспорта
-    if AUTO_EXPORT_ENABLED:
-        scheduler = BackgroundScheduler(timezone=TZ)
-        cron_parts = AUTO_EXPORT_CRON.split()
-        if len(cron_parts) == 5:
-            minute, hour, day, month, day_of_week = cron_parts
-            trigger = CronTrigger(
-                minute=minute,
-                hour=hour,
-                day=day,
-                month=month,
-                day_of_week=day_of_week
-            )
-            scheduler.add_job(scheduled_export, trigger)
-            scheduler.start()
-            logging.info(f"Scheduled export enabled: {AUTO_EXPORT_CRON}")
-        else:
-            logging.warning(f"Invalid cron expression: {AUTO_EXPORT_CRON}")
+    start_scheduler()
     
     logging.info("🤖 WhatsApp бот запущен!")
     logging.info("📡 Слушаю на %s:%s", SERVER_HOST, SERVER_PORT)
-    app.run(host=SERVER_HOST, port=SERVER_PORT, debug=False)
-
-
+    app.run(host=SERVER_HOST, port=SERVER_PORT, debug=False, threaded=True)
@@ -3,10 +3,13 @@
 Конфигурация бота из переменных окружения.
 """
 import os
+from types import MappingProxyType
 from dotenv import load_dotenv
 
-# Загрузка переменных из .env
-load_dotenv()
+# Загрузка переменных из .env. В продакшене окружение задаётся снаружи
+# (systemd, docker) - DOTENV_DISABLE=1 пропускает поиск и чтение файла
+if os.getenv("DOTENV_DISABLE") != "1":
+    load_dotenv()
 
 # 360dialog API настройки
 D360_API_KEY = os.getenv("D360_API_KEY")
@@ -23,9 +26,8 @@ SHEETS_ENABLED = os.getenv("SHEETS_ENABLED", "true").lower() == "true"
 SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
 SERVER_PORT = int(os.getenv("SERVER_PORT", "8000"))
 
-# Админы (номера телефонов)
-ADMIN_IDS = os.getenv("ADMIN_IDS", "").split(",")
-ADMIN_IDS = [admin_id.strip() for admin_id in ADMIN_IDS if admin_id.strip()]
+# Админы (номера телефонов): frozenset - проверка "phone in ADMIN_IDS" за O(1)
+ADMIN_IDS = frozenset(filter(None, (admin_id.strip() for admin_id in os.getenv("ADMIN_IDS", "").split(","))))
 
 # База данных
 DB_PATH = os.getenv("DB_PATH", "bot_data.db")
@@ -40,17 +42,22 @@ if not D360_API_KEY:
 if not VERIFY_TOKEN:
     raise ValueError("ERROR: VERIFY_TOKEN not found in .env file!")
 
+# Заголовки для запросов к 360dialog API: собираются один раз при импорте.
+# MappingProxyType - неизменяемое представление, безопасно делить между потоками.
+HEADERS = MappingProxyType({
+    "Content-Type": "application/json",
+    "D360-API-KEY": D360_API_KEY
+})
+
+
 def get_headers():
     """
     Возвращает заголовки для запросов к 360dialog API.
     
     Returns:
-        dict: Словарь с заголовками
+        Mapping: Неизменяемый словарь с заголовками (общий для всех вызовов)
     """
-    return {
-        "Content-Type": "application/json",
-        "D360-API-KEY": D360_API_KEY
-    }
+    return HEADERS
 
 
 print("[OK] Configuration loaded successfully")
@@ -44,5 +44,16 @@ MSG_NO_RECORDS = "Записей пока нет."
 # ============================================================================
 # Timeout для HTTP запросов (в секундах)
 # ============================================================================
-HTTP_TIMEOUT = 20
+HTTP_CONNECT_TIMEOUT = 3.05  # Установка соединения (чуть больше 3 с - окна повтора SYN)
+HTTP_TIMEOUT = 10            # Ожидание ответа
 
+# ============================================================================
+# TCP keepalive для пула соединений (в секундах)
+# ============================================================================
+TCP_KEEPALIVE_IDLE = 60      # Простой до первой keepalive-пробы
+TCP_KEEPALIVE_INTERVAL = 30  # Интервал между пробами
+
+# ============================================================================
+# Ограничение скорости отправки в 360dialog (сообщений в секунду)
+# ============================================================================
+SEND_RATE_LIMIT = 75         # С запасом ниже лимита Cloud API (80 MPS)
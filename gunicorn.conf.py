@@ -0,0 +1,31 @@
+# gunicorn.conf.py
+"""
+Настройки gunicorn для продакшен-запуска бота (вместо dev-сервера Flask).
+
+Запуск:
+    gunicorn bot:app
+
+gunicorn подхватывает этот файл автоматически из текущей директории.
+"""
+import os
+
+# Адрес и порт - те же переменные, что и для app.run()
+bind = f"{os.getenv('SERVER_HOST', '0.0.0.0')}:{os.getenv('SERVER_PORT', '8000')}"
+
+# Потоковые воркеры: пока один поток ждёт ответа 360dialog,
+# остальные принимают новые webhook-запросы
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "16"))
+
+# Состояния FSM хранятся в памяти процесса, поэтому по умолчанию один воркер:
+# иначе соседние сообщения пользователя попадут в разные процессы
+workers = int(os.getenv("WEB_WORKERS", "1"))
+
+# 360dialog ждёт ответ на webhook несколько секунд - дольше держать запрос нет смысла
+timeout = 30
+keepalive = 5
+
+# Приложение импортируется в мастер-процессе до fork: воркеры получают уже
+# загруженные модули (copy-on-write), а ошибка импорта видна сразу при старте.
+# Потоки и сетевые соединения создаются лениво, уже внутри воркера.
+preload_app = True
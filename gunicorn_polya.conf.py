@@ -0,0 +1,51 @@
+# gunicorn_polya.conf.py
+"""
+Настройки gunicorn для бота на pywa (bot_polya_whatsapp.py).
+
+Запуск:
+    gunicorn -c gunicorn_polya.conf.py bot_polya_whatsapp:app
+
+Для bot.py используется gunicorn.conf.py (подхватывается автоматически).
+"""
+import fcntl
+import os
+
+# Адрес и порт - те же переменные, что и для app.run()
+bind = f"{os.getenv('SERVER_HOST', '0.0.0.0')}:{os.getenv('SERVER_PORT', '8000')}"
+
+# Потоковые воркеры: webhook только ставит апдейт в очередь обработчиков,
+# поток сразу освобождается под следующий запрос
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "8"))
+
+# Состояния FSM и кэши пользователей живут в памяти процесса, поэтому по
+# умолчанию один воркер: иначе соседние нажатия пользователя попадут в разные
+# процессы и диалог потеряется
+workers = int(os.getenv("WEB_WORKERS", "1"))
+
+timeout = 30
+keepalive = 5
+
+# Модуль бота при импорте создаёт пулы потоков - импортируем его в каждом
+# воркере после fork, а не в мастер-процессе
+preload_app = False
+
+# Плановый экспорт должен идти в одном процессе, даже если воркеров несколько
+SCHEDULER_LOCK_PATH = os.getenv("SCHEDULER_LOCK_PATH", "scheduler.lock")
+
+
+def post_worker_init(worker):
+    import bot_polya_whatsapp as bot
+
+    bot.init_db()
+
+    # Планировщик запускает воркер, захвативший файловую блокировку. Она
+    # держится до конца жизни процесса; после перезапуска воркера её берёт новый
+    lock_file = open(SCHEDULER_LOCK_PATH, "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return
+    worker.scheduler_lock = lock_file
+    bot.start_scheduler()
@@ -5,10 +5,13 @@
 """
 
 import logging
+import re
 from datetime import date
+from types import MappingProxyType
 from typing import Optional
 from utils.api_360 import send_text, send_interactive_buttons, send_interactive_list
 from storage.attendance import save_attendance, get_last_entries
+from utils.state import get_state, set_state, clear_state, States
 from constants import (
     BTN_FILL_TODAY, BTN_FILL_RANGE, BTN_MY_STATUS,
     SHIFT_DAY, SHIFT_NIGHT, SHIFT_OFF, SHIFT_NAMES,
@@ -18,6 +21,166 @@ from constants import (
 
 logger = logging.getLogger(__name__)
 
+# Пустой dict для отсутствующих полей (не создаём новый на каждое сообщение)
+_EMPTY: dict = {}
+
+# Номер отправителя (wa_id): только цифры, 7-15 знаков (E.164 без "+";
+# в небольших странах номер вместе с кодом короче 10 цифр)
+_PHONE_RE = re.compile(r"[0-9]{7,15}")
+
+# Исходящие меню одинаковы для всех пользователей - собираются один раз при импорте.
+# Строки списка неизменяемые (MappingProxyType), их безопасно делить между потоками
+_MAIN_MENU_TEXT = f"{MSG_MAIN_MENU}\n\n1️⃣ Заполнить за сегодня\n2️⃣ Заполнить за период\n3️⃣ Мой статус"
+_UNKNOWN_COMMAND_TEXT = f"Неизвестная команда.\n\n{_MAIN_MENU_TEXT}"
+
+_SHIFT_ROWS = tuple(
+    MappingProxyType({"id": shift_id, "title": SHIFT_NAMES[shift_id]})
+    for shift_id in (SHIFT_DAY, SHIFT_NIGHT, SHIFT_OFF)
+)
+
+# Текстовое главное меню (пока вместо кнопок): номер пункта → ID кнопки
+_TEXT_MENU_CHOICES = {
+    "1": BTN_FILL_TODAY,
+    "2": BTN_FILL_RANGE,
+    "3": BTN_MY_STATUS,
+}
+
+
+def handle_incoming_message(message: dict) -> bool:
+    """
+    Главный роутер входящих сообщений от 360dialog.
+    
+    Единая точка разбора сообщения: webhook только передаёт сюда
+    сообщение из payload, повторно его не разбирая.
+    
+    Args:
+        message: Сообщение из webhook (элемент массива messages)
+    
+    Returns:
+        bool: True если обработано успешно
+    """
+    phone = message.get("from")
+    msg_type = message.get("type")
+    
+    # Некорректный отправитель не должен попасть в исходящие запросы к API
+    if not (isinstance(phone, str) and _PHONE_RE.fullmatch(phone)):
+        logger.warning("⚠️ Некорректный номер отправителя, сообщение пропущено")
+        # Сам номер - только в DEBUG, как и тела сообщений
+        logger.debug("[MSG] Отклонён отправитель: %r", phone)
+        return False
+    
+    # Неподдерживаемый тип отсекаем до обращения к FSM: get_state() заводит
+    # запись для нового номера, а мусорным вебхукам она не нужна
+    handler = _MESSAGE_HANDLERS.get(msg_type)
+    if handler is None:
+        logger.warning("⚠️ Неподдерживаемый тип сообщения: %s", msg_type)
+        return False
+    
+    # Текущее состояние FSM нужно только для лога
+    if logger.isEnabledFor(logging.INFO):
+        current_state = get_state(phone).get("state")
+        logger.info("[MSG] От %s, тип: %s, состояние FSM: %s", phone, msg_type, current_state)
+    
+    result = handler(phone, message)
+    if result is not None:
+        return result
+    
+    logger.warning("⚠️ Неподдерживаемый тип сообщения: %s", msg_type)
+    return False
+
+
+def _on_text(phone: str, message: dict) -> Optional[bool]:
+    """Разбирает сообщение типа text и передаёт текст в handle_text_message."""
+    # Прямой доступ вместо цепочки .get() с пустыми dict
+    try:
+        text_body = message["text"]["body"].strip()
+    except (KeyError, TypeError, AttributeError):
+        text_body = ""
+    return handle_text_message(phone, text_body)
+
+
+def _on_interactive(phone: str, message: dict) -> Optional[bool]:
+    """
+    Разбирает сообщение типа interactive (кнопка или список).
+    
+    Returns:
+        Результат обработчика или None, если подтип не поддерживается
+    """
+    interactive = message.get("interactive") or _EMPTY
+    interactive_type = interactive.get("type")
+    
+    if interactive_type == "button_reply":
+        button_reply = interactive.get("button_reply") or _EMPTY
+        return handle_button_click(phone, button_reply.get("id", ""))
+    
+    if interactive_type == "list_reply":
+        list_reply = interactive.get("list_reply") or _EMPTY
+        return handle_list_selection(phone, list_reply.get("id", ""), list_reply.get("title"))
+    
+    return None
+
+
+# Тип входящего сообщения → разбор (один поиск в dict вместо цепочки if)
+_MESSAGE_HANDLERS = {
+    "text": _on_text,
+    "interactive": _on_interactive,
+}
+
+
+def handle_text_message(phone: str, text: str) -> bool:
+    """
+    Обрабатывает текстовое сообщение.
+    
+    Номер пункта текстового меню ("1", "2", "3") обрабатывается как нажатие
+    соответствующей кнопки, любой другой текст показывает главное меню.
+    
+    Args:
+        phone: Номер телефона пользователя
+        text: Текст сообщения (без пробелов по краям)
+    
+    Returns:
+        bool: True если обработано успешно
+    """
+    # Тело сообщения - только в DEBUG
+    logger.debug("[TEXT] %s: %s", phone, text)
+    
+    button_id = _TEXT_MENU_CHOICES.get(text)
+    if button_id:
+        return handle_main_menu_button(phone, button_id)
+    
+    return send_main_menu(phone)
+
+
+def handle_button_click(phone: str, button_id: str) -> bool:
+    """
+    Обрабатывает нажатие интерактивной кнопки.
+    
+    Args:
+        phone: Номер телефона пользователя
+        button_id: ID нажатой кнопки
+    
+    Returns:
+        bool: True если обработано успешно
+    """
+    logger.info("[BUTTON] %s: %s", phone, button_id)
+    return handle_main_menu_button(phone, button_id)
+
+
+def handle_list_selection(phone: str, list_id: str, title: Optional[str] = None) -> bool:
+    """
+    Обрабатывает выбор элемента интерактивного списка.
+    
+    Args:
+        phone: Номер телефона пользователя
+        list_id: ID выбранного элемента
+        title: Название выбранного элемента (опционально)
+    
+    Returns:
+        bool: True если обработано успешно
+    """
+    logger.info("[LIST] %s: %s (%s)", phone, list_id, title or 'N/A')
+    return handle_shift_selection(phone, list_id, title)
+
 
 def send_main_menu(to: str) -> bool:
     """
@@ -30,8 +193,9 @@ def send_main_menu(to: str) -> bool:
         bool: True если отправлено успешно
     """
     # Временно отправляем текстовое сообщение для теста
-    logger.info(f"📋 Отправка главного меню → {to}")
-    return send_text(to, f"{MSG_MAIN_MENU}\n\n1️⃣ Заполнить за сегодня\n2️⃣ Заполнить за период\n3️⃣ Мой статус")
+    logger.info("📋 Отправка главного меню → %s", to)
+    set_state(to, States.MAIN_MENU)
+    return send_text(to, _MAIN_MENU_TEXT)
     
     # buttons = [
     #     {"id": BTN_FILL_TODAY, "title": "Заполнить за сегодня"},
@@ -51,14 +215,9 @@ def send_shift_list(to: str) -> bool:
     Returns:
         bool: True если отправлено успешно
     """
-    rows = [
-        {"id": SHIFT_DAY, "title": SHIFT_NAMES[SHIFT_DAY]},
-        {"id": SHIFT_NIGHT, "title": SHIFT_NAMES[SHIFT_NIGHT]},
-        {"id": SHIFT_OFF, "title": SHIFT_NAMES[SHIFT_OFF]}
-    ]
-    
-    logger.info(f"⏰ Отправка списка смен → {to}")
-    return send_interactive_list(to, MSG_SHIFT_SELECT, "Смены", rows)
+    logger.info("⏰ Отправка списка смен → %s", to)
+    set_state(to, States.SELECT_SHIFT)
+    return send_interactive_list(to, MSG_SHIFT_SELECT, "Смены", _SHIFT_ROWS)
 
 
 def handle_main_menu_button(to: str, button_id: str) -> bool:
@@ -72,23 +231,28 @@ def handle_main_menu_button(to: str, button_id: str) -> bool:
     Returns:
         bool: True если обработано успешно
     """
-    logger.info(f"🔘 Обработка кнопки главного меню: {button_id} от {to}")
+    logger.info("🔘 Обработка кнопки главного меню: %s от %s", button_id, to)
     
-    if button_id == BTN_FILL_TODAY:
-        # Показываем список смен для заполнения за сегодня
-        return send_shift_list(to)
-    
-    elif button_id == BTN_FILL_RANGE:
-        # Пока не реализовано - отправляем заглушку
-        return send_text(to, MSG_RANGE_COMING_SOON)
+    handler = _MAIN_MENU_HANDLERS.get(button_id)
+    if handler is None:
+        logger.warning("⚠️ Неизвестная кнопка главного меню: %s", button_id)
+        # Ошибка и меню - одним сообщением, без второго запроса к API
+        set_state(to, States.MAIN_MENU)
+        return send_text(to, _UNKNOWN_COMMAND_TEXT)
+    return handler(to)
+
+
+def send_range_stub(to: str) -> bool:
+    """
+    Отвечает на "Заполнить за период" (пока не реализовано).
     
-    elif button_id == BTN_MY_STATUS:
-        # Показываем последние 3 записи пользователя
-        return show_user_status(to)
+    Args:
+        to: Номер телефона пользователя
     
-    else:
-        logger.warning(f"⚠️ Неизвестная кнопка главного меню: {button_id}")
-        return send_text(to, "Неизвестная команда. Попробуйте снова.")
+    Returns:
+        bool: True если отправлено успешно
+    """
+    return send_text(to, MSG_RANGE_COMING_SOON)
 
 
 def handle_shift_selection(to: str, shift_id: str, title: Optional[str] = None) -> bool:
@@ -103,24 +267,24 @@ def handle_shift_selection(to: str, shift_id: str, title: Optional[str] = None)
     Returns:
         bool: True если обработано успешно
     """
-    logger.info(f"✅ Выбор смены: {shift_id} ({title or 'N/A'}) от {to}")
+    logger.info("✅ Выбор смены: %s (%s) от %s", shift_id, title or 'N/A', to)
     
-    # Проверяем что это корректная смена
-    if shift_id not in SHIFT_NAMES:
-        logger.warning(f"⚠️ Неизвестный ID смены: {shift_id}")
+    # Проверка и получение названия смены - одним поиском в SHIFT_NAMES
+    shift_name = SHIFT_NAMES.get(shift_id)
+    if shift_name is None:
+        logger.warning("⚠️ Неизвестный ID смены: %s", shift_id)
         return send_text(to, "Неизвестная смена. Попробуйте снова.")
     
-    # Получаем название смены и текущую дату
-    shift_name = SHIFT_NAMES[shift_id]
     today = date.today().isoformat()  # Формат: YYYY-MM-DD
     
     # Сохраняем запись о смене
     try:
         save_attendance(to, today, shift_name)
-        logger.info(f"💾 Смена сохранена: {to} / {today} / {shift_name}")
+        logger.info("💾 Смена сохранена: %s / %s / %s", to, today, shift_name)
+        clear_state(to)
         return send_text(to, MSG_SHIFT_SAVED)
     except Exception as e:
-        logger.error(f"❌ Ошибка сохранения смены: {e}", exc_info=True)
+        logger.error("❌ Ошибка сохранения смены: %s", e, exc_info=True)
         return send_text(to, "Ошибка при сохранении. Попробуйте позже.")
 
 
@@ -134,7 +298,7 @@ def show_user_status(to: str) -> bool:
     Returns:
         bool: True если отправлено успешно
     """
-    logger.info(f"📊 Запрос статуса от {to}")
+    logger.info("📊 Запрос статуса от %s", to)
     
     # Получаем последние 3 записи
     entries = get_last_entries(to, n=3)
@@ -151,5 +315,13 @@ def show_user_status(to: str) -> bool:
     
     status_text = "\n".join(lines)
     
-    logger.info(f"📤 Отправка статуса ({len(entries)} записей) → {to}")
+    logger.info("📤 Отправка статуса (%s записей) → %s", len(entries), to)
     return send_text(to, status_text)
+
+
+# Кнопки главного меню: ID кнопки → обработчик (to) -> bool
+_MAIN_MENU_HANDLERS = {
+    BTN_FILL_TODAY: send_shift_list,    # список смен для заполнения за сегодня
+    BTN_FILL_RANGE: send_range_stub,    # пока заглушка
+    BTN_MY_STATUS: show_user_status,    # последние 3 записи пользователя
+}
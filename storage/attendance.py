@@ -4,17 +4,24 @@
 Использует JSON файл data/attendance.json для хранения записей о сменах сотрудников.
 """
 
-import json
 import os
+import tempfile
+import threading
 from datetime import date
 from typing import Dict, List
 import logging
 
+import orjson
+
 logger = logging.getLogger(__name__)
 
 # Путь к файлу с данными
 DATA_FILE = os.path.join("data", "attendance.json")
 
+# Сохранения идут из фоновых потоков webhook: чтение-изменение-запись файла
+# выполняется под одной блокировкой, иначе параллельные записи теряются
+_data_lock = threading.Lock()
+
 
 def load_data() -> dict:
     """
@@ -25,19 +32,19 @@ def load_data() -> dict:
               Формат: {user_id: [{"date": "YYYY-MM-DD", "shift": "название смены"}, ...]}
     """
     if not os.path.exists(DATA_FILE):
-        logger.info(f"Файл {DATA_FILE} не найден, возвращаем пустой словарь")
+        logger.info("Файл %s не найден, возвращаем пустой словарь", DATA_FILE)
         return {}
     
     try:
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            logger.info(f"Загружено записей для {len(data)} пользователей")
+        with open(DATA_FILE, 'rb') as f:
+            data = orjson.loads(f.read())
+            logger.info("Загружено записей для %s пользователей", len(data))
             return data
-    except json.JSONDecodeError as e:
-        logger.error(f"Ошибка чтения JSON: {e}")
+    except orjson.JSONDecodeError as e:
+        logger.error("Ошибка чтения JSON: %s", e)
         return {}
     except Exception as e:
-        logger.error(f"Ошибка загрузки данных: {e}")
+        logger.error("Ошибка загрузки данных: %s", e)
         return {}
 
 
@@ -50,26 +57,28 @@ def save_data(data: dict) -> None:
         data: Словарь с данными для сохранения
     """
     # Создаем директорию если её нет
-    os.makedirs(os.path.dirname(DATA_FILE), exist_ok=True)
+    data_dir = os.path.dirname(DATA_FILE)
+    os.makedirs(data_dir, exist_ok=True)
     
-    # Атомарная запись через временный файл
-    temp_file = DATA_FILE + ".tmp"
+    # Атомарная запись через уникальный временный файл в той же директории
+    temp_file = None
     
     try:
-        with open(temp_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        # orjson пишет UTF-8 без экранирования кириллицы, как ensure_ascii=False
+        with tempfile.NamedTemporaryFile(dir=data_dir, suffix=".tmp", delete=False) as f:
+            temp_file = f.name
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
         
-        # Замена оригинального файла на временный
-        if os.path.exists(DATA_FILE):
-            os.remove(DATA_FILE)
-        os.rename(temp_file, DATA_FILE)
+        # os.replace атомарно подменяет файл: читатель видит либо старую,
+        # либо новую версию, но никогда отсутствующий файл
+        os.replace(temp_file, DATA_FILE)
         
-        logger.info(f"Данные успешно сохранены в {DATA_FILE}")
+        logger.info("Данные успешно сохранены в %s", DATA_FILE)
         
     except Exception as e:
-        logger.error(f"Ошибка сохранения данных: {e}")
+        logger.error("Ошибка сохранения данных: %s", e)
         # Удаляем временный файл в случае ошибки
-        if os.path.exists(temp_file):
+        if temp_file and os.path.exists(temp_file):
             os.remove(temp_file)
         raise
 
@@ -83,24 +92,22 @@ def save_attendance(user_id: str, date_str: str, shift: str) -> None:
         date_str: Дата в формате YYYY-MM-DD
         shift: Название смены
     """
-    # Загружаем текущие данные
-    data = load_data()
-    
-    # Создаем массив для пользователя, если его еще нет
-    if user_id not in data:
-        data[user_id] = []
-    
-    # Добавляем новую запись
     entry = {
         "date": date_str,
         "shift": shift
     }
-    data[user_id].append(entry)
     
-    # Сохраняем обновленные данные
-    save_data(data)
+    with _data_lock:
+        # Загружаем текущие данные
+        data = load_data()
+        
+        # Создаем массив для пользователя и добавляем новую запись
+        data.setdefault(user_id, []).append(entry)
+        
+        # Сохраняем обновленные данные
+        save_data(data)
     
-    logger.info(f"Сохранена смена для {user_id}: {date_str} - {shift}")
+    logger.info("Сохранена смена для %s: %s - %s", user_id, date_str, shift)
 
 
 def get_last_entries(user_id: str, n: int = 3) -> List[dict]:
@@ -224,13 +224,13 @@ def test_main_menu():
     print_header("ТЕСТ 6: Главное меню бота")
     
     try:
-        from menu_handlers import handle_main_menu
+        from menu_handlers import send_main_menu
         
         print_info(f"Отправка главного меню на: {TEST_PHONE}")
-        handle_main_menu(TEST_PHONE)
+        send_main_menu(TEST_PHONE)
         
         print_success("Главное меню отправлено!")
-        print_info("Проверьте WhatsApp - должны появиться кнопки: Работа, Часы, Помощь")
+        print_info("Проверьте WhatsApp - должно прийти меню: 1️⃣ сегодня, 2️⃣ период, 3️⃣ статус")
         return True
     except Exception as e:
         print_error(f"Ошибка отправки главного меню: {e}")
@@ -242,10 +242,10 @@ def test_shift_menu():
     print_header("ТЕСТ 7: Меню смен")
     
     try:
-        from menu_handlers import handle_shift_menu
+        from menu_handlers import send_shift_list
         
         print_info(f"Отправка меню смен на: {TEST_PHONE}")
-        handle_shift_menu(TEST_PHONE)
+        send_shift_list(TEST_PHONE)
         
         print_success("Меню смен отправлено!")
         print_info("Проверьте WhatsApp - должен появиться список с 3 сменами")
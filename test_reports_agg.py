@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Тестовый скрипт для проверки дневных агрегатов отчётов (reports_daily_agg).
+
+Проверяет, что триггеры на reports держат агрегаты в согласии с самими
+отчётами, в том числе для отчётов без места/работы (NULL).
+
+Использование:
+    python test_reports_agg.py
+
+Нужны зависимости из requirements_whatsapp.txt. Работает на временной БД,
+рабочая reports_whatsapp.db не затрагивается.
+"""
+import os
+import sys
+import io
+import tempfile
+from contextlib import closing
+
+# Настройка кодировки для Windows
+if sys.platform == 'win32':
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
+
+# Модуль бота требует эти переменные при импорте - для теста хватит заглушек
+os.environ.setdefault("WHATSAPP_TOKEN", "test")
+os.environ.setdefault("WHATSAPP_PHONE_ID", "test")
+os.environ.setdefault("VERIFY_TOKEN", "test")
+
+import bot_polya_whatsapp as bot
+
+# Соединения открываются лениво - до первого запроса можно подменить путь к БД
+_tmp_dir = tempfile.mkdtemp(prefix="agg_test_")
+bot.DB_PATH = os.path.join(_tmp_dir, "reports_test.db")
+
+TEST_USER = "79990000000"
+TEST_DATE = "2025-01-15"
+
+
+class Colors:
+    GREEN = '\033[92m'
+    RED = '\033[91m'
+    BLUE = '\033[94m'
+    YELLOW = '\033[93m'
+    RESET = '\033[0m'
+    BOLD = '\033[1m'
+
+def print_success(text):
+    print(f"{Colors.GREEN}✓{Colors.RESET} {text}")
+
+def print_error(text):
+    print(f"{Colors.RED}✗{Colors.RESET} {text}")
+
+def print_info(text):
+    print(f"{Colors.BLUE}ℹ{Colors.RESET} {text}")
+
+def print_header(text):
+    print(f"\n{Colors.BOLD}{Colors.YELLOW}{'='*70}{Colors.RESET}")
+    print(f"{Colors.BOLD}{Colors.YELLOW}{text:^70}{Colors.RESET}")
+    print(f"{Colors.BOLD}{Colors.YELLOW}{'='*70}{Colors.RESET}\n")
+
+
+def agg_rows():
+    """Содержимое reports_daily_agg для тестового пользователя."""
+    with bot.WRITE_POOL.acquire() as con, closing(con.cursor()) as c:
+        return sorted(c.execute(
+            "SELECT work_date, location, activity, hours_sum, rows_count "
+            "FROM reports_daily_agg WHERE user_id=?", (TEST_USER,)
+        ).fetchall())
+
+
+def expected_rows():
+    """Те же суммы, посчитанные напрямую по reports."""
+    with bot.WRITE_POOL.acquire() as con, closing(con.cursor()) as c:
+        return sorted(c.execute(
+            "SELECT work_date, coalesce(location, ''), coalesce(activity, ''), "
+            "coalesce(SUM(hours), 0), COUNT(*) FROM reports WHERE user_id=? "
+            "GROUP BY work_date, coalesce(location, ''), coalesce(activity, '')", (TEST_USER,)
+        ).fetchall())
+
+
+def check_consistent(step: str):
+    actual, expected = agg_rows(), expected_rows()
+    print_info(f"{step}: {actual}")
+    assert actual == expected, f"{step}: агрегаты {actual} != отчёты {expected}"
+
+
+# ============================================================================
+# ТЕСТЫ
+# ============================================================================
+
+def test_null_location():
+    """Тест 1: вставка, изменение и удаление отчётов без места"""
+    print_header("ТЕСТ 1: Отчёты с location = NULL")
+
+    try:
+        bot.init_db()
+
+        first = bot.insert_report(TEST_USER, "Тест", None, None, "Полив", "hand", TEST_DATE, 4)
+        second = bot.insert_report(TEST_USER, "Тест", None, None, "Полив", "hand", TEST_DATE, 3)
+        check_consistent("Две вставки")
+        assert agg_rows() == [(TEST_DATE, "", "Полив", 7, 2)], "NULL-группы не слились в одну строку"
+        print_success("Отчёты без места объединены в одну строку агрегата")
+
+        assert bot.update_report_hours(first, TEST_USER, 6)
+        check_consistent("Изменение часов")
+        assert agg_rows() == [(TEST_DATE, "", "Полив", 9, 2)], "Изменение часов не учтено"
+        print_success("Изменение часов пересчитало агрегат")
+
+        with bot.WRITE_POOL.acquire() as con:
+            con.execute("UPDATE reports SET location=? WHERE id=?", ("Поле 1", second))
+        check_consistent("Перенос отчёта на место")
+        print_success("Смена места перенесла часы в другую группу")
+
+        assert bot.delete_report(first, TEST_USER)
+        assert bot.delete_report(second, TEST_USER)
+        check_consistent("Удаление")
+        assert agg_rows() == [], "После удаления всех отчётов остались строки агрегата"
+        print_success("Удаление отчётов очистило агрегат")
+
+        rows = bot.fetch_stats_range_for_user(TEST_USER, TEST_DATE, TEST_DATE)
+        assert rows == [], f"Статистика не пуста: {rows}"
+
+        return True
+    except Exception as e:
+        print_error(f"Ошибка: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_stats_output():
+    """Тест 2: статистика показывает пустое место как раньше (None)"""
+    print_header("ТЕСТ 2: Статистика по отчётам без места и работы")
+
+    try:
+        bot.insert_report(TEST_USER, "Тест", None, None, None, None, TEST_DATE, 5)
+        check_consistent("Вставка без места и работы")
+
+        rows = [tuple(r) for r in bot.fetch_stats_range_for_user(TEST_USER, TEST_DATE, TEST_DATE)]
+        print_info(f"fetch_stats_range_for_user: {rows}")
+        assert rows == [(TEST_DATE, None, None, 5)], "Пустые ключи должны возвращаться как NULL"
+        print_success("Статистика возвращает None для отсутствующих места/работы")
+
+        return True
+    except Exception as e:
+        print_error(f"Ошибка: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+# ============================================================================
+# ГЛАВНАЯ ФУНКЦИЯ
+# ============================================================================
+
+def main():
+    """Запуск всех тестов"""
+    tests = [
+        ("Отчёты с location = NULL", test_null_location),
+        ("Статистика без места и работы", test_stats_output),
+    ]
+
+    results = [(name, func()) for name, func in tests]
+
+    print_header("РЕЗУЛЬТАТЫ ТЕСТИРОВАНИЯ")
+    passed = sum(1 for _, result in results if result)
+    for test_name, result in results:
+        status = f"{Colors.GREEN}✓ PASSED{Colors.RESET}" if result else f"{Colors.RED}✗ FAILED{Colors.RESET}"
+        print(f"  {status}  {test_name}")
+    print(f"\n{Colors.BOLD}Итого: {passed}/{len(results)} тестов пройдено{Colors.RESET}\n")
+
+    if passed != len(results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,100 +6,190 @@ HTTP-клиент для работы с 360dialog WhatsApp Business API.
 
 import os
 import logging
+import socket
+import threading
+import time
+from functools import lru_cache
+from types import MappingProxyType
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
 from typing import List, Dict, Optional
-from constants import D360_BASE_URL, HTTP_TIMEOUT
+from constants import (
+    D360_BASE_URL, HTTP_CONNECT_TIMEOUT, HTTP_TIMEOUT,
+    TCP_KEEPALIVE_IDLE, TCP_KEEPALIVE_INTERVAL, SEND_RATE_LIMIT
+)
 
 logger = logging.getLogger(__name__)
 
 # Получаем API ключ из переменных окружения
 D360_API_KEY = os.getenv("D360_API_KEY")
 
+# Заголовки собираются один раз; сессия подставляет их в каждый запрос
+_HEADERS = MappingProxyType({
+    "D360-API-KEY": D360_API_KEY,
+    "Content-Type": "application/json"
+})
 
-def _get_headers() -> dict:
+
+# Раздельные таймауты: долгий connect (DNS, потеря SYN) не держит поток 10+ секунд
+_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_TIMEOUT)
+
+
+def _keepalive_socket_options() -> list:
     """
-    Возвращает заголовки для запросов к 360dialog API.
+    Опции сокета для соединений пула: стандартные urllib3 (TCP_NODELAY) + TCP keepalive.
+    
+    Без keepalive простаивающие соединения между пиками webhook'ов
+    закрываются NAT/балансировщиками, и следующая отправка снова платит
+    за TCP+TLS handshake. TCP_KEEPIDLE/TCP_KEEPINTVL есть не на всех ОС.
     
     Returns:
-        dict: Словарь с заголовками
+        list: Список (level, option, value) для socket.setsockopt
     """
-    return {
-        "D360-API-KEY": D360_API_KEY,
-        "Content-Type": "application/json"
-    }
+    options = list(HTTPConnection.default_socket_options)
+    options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, TCP_KEEPALIVE_IDLE))
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, TCP_KEEPALIVE_INTERVAL))
+    return options
 
 
-def send_text(to: str, text: str) -> bool:
+class _KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter, включающий TCP keepalive на сокетах пула."""
+    
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = _keepalive_socket_options()
+        super().init_poolmanager(*args, **kwargs)
+
+
+def _create_session() -> requests.Session:
     """
-    Отправляет текстовое сообщение пользователю.
+    Создаёт HTTP-сессию с пулом keep-alive соединений к 360dialog.
     
-    Args:
-        to: Номер телефона получателя (без +, например: 79991234567)
-        text: Текст сообщения (поддерживает WhatsApp форматирование)
+    Все отправки идут на один хост, поэтому соединение (TCP + TLS)
+    переиспользуется, а не открывается заново на каждое сообщение.
+    POST не повторяется по статусу ответа (запрос не идемпотентен),
+    повторяются только ошибки установки соединения.
     
     Returns:
-        bool: True если отправлено успешно, False в случае ошибки
+        requests.Session: Сессия с заголовками авторизации
     """
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": to,
-        "type": "text",
-        "text": {
-            "body": text
-        }
-    }
+    session = requests.Session()
+    session.headers.update(_HEADERS)
     
-    try:
-        logger.info(f"📤 Отправка текста → {to}")
-        response = requests.post(
-            D360_BASE_URL,
-            json=payload,
-            headers=_get_headers(),
-            timeout=HTTP_TIMEOUT
-        )
-        
-        if response.status_code in [200, 201]:
-            logger.info(f"✅ Текст отправлен → {to}")
-            return True
-        else:
-            logger.error(f"❌ Ошибка {response.status_code}: {response.text}")
-            return False
-            
-    except requests.exceptions.Timeout:
-        logger.error(f"⏱️ Timeout при отправке сообщения → {to}")
-        return False
-    except Exception as e:
-        logger.error(f"❌ Исключение при отправке: {e}", exc_info=True)
-        return False
+    retry = Retry(total=2, backoff_factor=0.2, status_forcelist=[429, 502, 503, 504])
+    adapter = _KeepAliveAdapter(pool_connections=10, pool_maxsize=50, max_retries=retry)
+    session.mount("https://", adapter)
+    
+    return session
 
 
-def send_interactive_buttons(to: str, body_text: str, buttons_list: List[Dict[str, str]]) -> bool:
+# Общая сессия на весь процесс
+_session = _create_session()
+
+
+class _TokenBucket:
     """
-    Отправляет интерактивное сообщение с кнопками (reply buttons).
+    Потокобезопасный token bucket: не больше rate отправок в секунду.
+    
+    Фоновые потоки webhook'а отправляют ответы параллельно; при пике
+    они упёрлись бы в лимит 360dialog/Meta и получили 429 с повторами.
+    Лучше заранее притормозить отправку на доли секунды.
+    """
+    
+    def __init__(self, rate: float):
+        self._rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """Забирает один токен, при необходимости ждёт его появления."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._rate, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            self._tokens -= 1
+            # Токен уже "занят" (может уйти в минус) - ждём вне блокировки
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+
+
+# Лимит переопределяется через D360_SEND_RATE (0 - без ограничения)
+_SEND_RATE = float(os.getenv("D360_SEND_RATE", SEND_RATE_LIMIT))
+_send_limiter = _TokenBucket(_SEND_RATE) if _SEND_RATE > 0 else None
+
+
+# Меню отправляются тысячам пользователей с одними и теми же кнопками,
+# поэтому готовые блоки кэшируются. Результат только сериализуется
+# в orjson.dumps() и не изменяется, так что его можно переиспользовать.
+@lru_cache(maxsize=64)
+def _build_button_components(buttons: tuple) -> list:
+    """
+    Собирает кнопки в формате 360dialog.
     
     Args:
-        to: Номер телефона получателя
-        body_text: Текст сообщения
-        buttons_list: Список кнопок, например: [{"id": "BTN_ID", "title": "Кнопка"}, ...]
-                     Максимум 3 кнопки (ограничение WhatsApp)
+        buttons: Кортеж пар (id, title)
     
     Returns:
-        bool: True если отправлено успешно
+        list: Список кнопок для action.buttons
     """
-    # Формируем кнопки в формате 360dialog
-    button_components = []
-    for btn in buttons_list[:3]:  # Максимум 3 кнопки
-        button_components.append({
+    return [
+        {
             "type": "reply",
             "reply": {
-                "id": btn["id"],
-                "title": btn["title"][:20]  # Максимум 20 символов для title
+                "id": button_id,
+                "title": title[:20]  # Максимум 20 символов для title
             }
-        })
+        }
+        for button_id, title in buttons
+    ]
+
+
+@lru_cache(maxsize=64)
+def _build_list_rows(rows: tuple) -> list:
+    """
+    Собирает строки списка в формате 360dialog.
+    
+    Args:
+        rows: Кортеж троек (id, title, description), description может быть None
+    
+    Returns:
+        list: Список строк для секции списка
+    """
+    list_rows = []
+    for row_id, title, description in rows:
+        row_data = {
+            "id": row_id,
+            "title": title[:24]  # Максимум 24 символа для title
+        }
+        # Добавляем description если есть
+        if description is not None:
+            row_data["description"] = description[:72]  # Максимум 72 символа
+        
+        list_rows.append(row_data)
+    return list_rows
+
+
+@lru_cache(maxsize=64)
+def _buttons_tail(body_text: str, buttons: tuple) -> bytes:
+    """
+    JSON сообщения с кнопками без открывающей скобки и поля "to".
+    
+    Args:
+        body_text: Текст сообщения
+        buttons: Кортеж пар (id, title)
     
-    payload = {
+    Returns:
+        bytes: '"messaging_product":...,"interactive":{...}}'
+    """
+    return orjson.dumps({
         "messaging_product": "whatsapp",
-        "to": to,
         "type": "interactive",
         "interactive": {
             "type": "button",
@@ -107,66 +197,31 @@ def send_interactive_buttons(to: str, body_text: str, buttons_list: List[Dict[st
                 "text": body_text
             },
             "action": {
-                "buttons": button_components
+                "buttons": _build_button_components(buttons)
             }
         }
-    }
-    
-    try:
-        logger.info(f"📤 Отправка кнопок ({len(button_components)} шт) → {to}")
-        response = requests.post(
-            D360_BASE_URL,
-            json=payload,
-            headers=_get_headers(),
-            timeout=HTTP_TIMEOUT
-        )
-        
-        if response.status_code in [200, 201]:
-            logger.info(f"✅ Кнопки отправлены → {to}")
-            return True
-        else:
-            logger.error(f"❌ Ошибка {response.status_code}: {response.text}")
-            return False
-            
-    except requests.exceptions.Timeout:
-        logger.error(f"⏱️ Timeout при отправке кнопок → {to}")
-        return False
-    except Exception as e:
-        logger.error(f"❌ Исключение при отправке кнопок: {e}", exc_info=True)
-        return False
+    })[1:]
 
 
-def send_interactive_list(to: str, body_text: str, section_title: str, rows: List[Dict[str, str]]) -> bool:
+@lru_cache(maxsize=64)
+def _list_tail(body_text: str, section_title: str, rows: tuple) -> bytes:
     """
-    Отправляет интерактивное сообщение со списком (list message).
+    JSON сообщения-списка без открывающей скобки и поля "to".
+    
+    Списки (например, смены) одинаковы для всех пользователей, поэтому
+    сериализованная часть кэшируется, а на каждый вызов остаётся только
+    подставить получателя.
     
     Args:
-        to: Номер телефона получателя
         body_text: Текст сообщения
         section_title: Заголовок секции списка
-        rows: Список элементов, например:
-              [{"id": "ROW_ID", "title": "Заголовок", "description": "Описание"}, ...]
-              description - опционально
+        rows: Кортеж троек (id, title, description)
     
     Returns:
-        bool: True если отправлено успешно
+        bytes: '"messaging_product":...,"interactive":{...}}'
     """
-    # Формируем строки списка в формате 360dialog
-    list_rows = []
-    for row in rows:
-        row_data = {
-            "id": row["id"],
-            "title": row["title"][:24]  # Максимум 24 символа для title
-        }
-        # Добавляем description если есть
-        if "description" in row:
-            row_data["description"] = row["description"][:72]  # Максимум 72 символа
-        
-        list_rows.append(row_data)
-    
-    payload = {
+    return orjson.dumps({
         "messaging_product": "whatsapp",
-        "to": to,
         "type": "interactive",
         "interactive": {
             "type": "list",
@@ -178,32 +233,128 @@ def send_interactive_list(to: str, body_text: str, section_title: str, rows: Lis
                 "sections": [
                     {
                         "title": section_title,
-                        "rows": list_rows
+                        "rows": _build_list_rows(rows)
                     }
                 ]
             }
         }
-    }
+    })[1:]
+
+
+@lru_cache(maxsize=256)
+def _text_tail(text: str) -> bytes:
+    """
+    JSON текстового сообщения без открывающей скобки и поля "to".
+    
+    Бот отвечает в основном фиксированными фразами (главное меню,
+    подтверждения), поэтому сериализованная часть кэшируется по тексту.
+    
+    Args:
+        text: Текст сообщения
+    
+    Returns:
+        bytes: '"messaging_product":...,"text":{...}}'
+    """
+    return orjson.dumps({
+        "messaging_product": "whatsapp",
+        "type": "text",
+        "text": {
+            "body": text
+        }
+    })[1:]
+
+
+def _post(to: str, tail: bytes, what: str) -> bool:
+    """
+    Отправляет сообщение в 360dialog через общую сессию.
+    
+    Общая часть всех send_*: подстановка получателя, запрос,
+    проверка статуса и логирование ошибок.
+    
+    Args:
+        to: Номер телефона получателя
+        tail: Сериализованное сообщение без "{" и поля "to" (из _*_tail)
+        what: Что отправляется (для логов): "текста", "кнопок", "списка"
+    
+    Returns:
+        bool: True если отправлено успешно
+    """
+    payload = b'{"to":' + orjson.dumps(to) + b"," + tail
+    
+    if _send_limiter is not None:
+        _send_limiter.acquire()
     
     try:
-        logger.info(f"📤 Отправка списка ({len(list_rows)} элементов) → {to}")
-        response = requests.post(
+        response = _session.post(
             D360_BASE_URL,
-            json=payload,
-            headers=_get_headers(),
-            timeout=HTTP_TIMEOUT
+            data=payload,
+            timeout=_TIMEOUT
         )
         
-        if response.status_code in [200, 201]:
-            logger.info(f"✅ Список отправлен → {to}")
+        if response.status_code in (200, 201):
+            logger.info("✅ Отправка %s выполнена → %s", what, to)
             return True
-        else:
-            logger.error(f"❌ Ошибка {response.status_code}: {response.text}")
-            return False
-            
+        
+        logger.error("❌ Ошибка %s: %s", response.status_code, response.text)
+        return False
+    
     except requests.exceptions.Timeout:
-        logger.error(f"⏱️ Timeout при отправке списка → {to}")
+        logger.error("⏱️ Timeout при отправке %s → %s", what, to)
         return False
     except Exception as e:
-        logger.error(f"❌ Исключение при отправке списка: {e}", exc_info=True)
+        logger.error("❌ Исключение при отправке %s: %s", what, e, exc_info=True)
         return False
+
+
+def send_text(to: str, text: str) -> bool:
+    """
+    Отправляет текстовое сообщение пользователю.
+    
+    Args:
+        to: Номер телефона получателя (без +, например: 79991234567)
+        text: Текст сообщения (поддерживает WhatsApp форматирование)
+    
+    Returns:
+        bool: True если отправлено успешно, False в случае ошибки
+    """
+    logger.info("📤 Отправка текста → %s", to)
+    return _post(to, _text_tail(text), "текста")
+
+
+def send_interactive_buttons(to: str, body_text: str, buttons_list: List[Dict[str, str]]) -> bool:
+    """
+    Отправляет интерактивное сообщение с кнопками (reply buttons).
+    
+    Args:
+        to: Номер телефона получателя
+        body_text: Текст сообщения
+        buttons_list: Список кнопок, например: [{"id": "BTN_ID", "title": "Кнопка"}, ...]
+                     Максимум 3 кнопки (ограничение WhatsApp)
+    
+    Returns:
+        bool: True если отправлено успешно
+    """
+    # Максимум 3 кнопки (ограничение WhatsApp)
+    button_pairs = tuple((btn["id"], btn["title"]) for btn in buttons_list[:3])
+    logger.info("📤 Отправка кнопок (%s шт) → %s", len(button_pairs), to)
+    return _post(to, _buttons_tail(body_text, button_pairs), "кнопок")
+
+
+def send_interactive_list(to: str, body_text: str, section_title: str, rows: List[Dict[str, str]]) -> bool:
+    """
+    Отправляет интерактивное сообщение со списком (list message).
+    
+    Args:
+        to: Номер телефона получателя
+        body_text: Текст сообщения
+        section_title: Заголовок секции списка
+        rows: Список элементов, например:
+              [{"id": "ROW_ID", "title": "Заголовок", "description": "Описание"}, ...]
+              description - опционально
+    
+    Returns:
+        bool: True если отправлено успешно
+    """
+    row_tuples = tuple((row["id"], row["title"], row.get("description")) for row in rows)
+    logger.info("📤 Отправка списка (%s элементов) → %s", len(row_tuples), to)
+    return _post(to, _list_tail(body_text, section_title, row_tuples), "списка")
@@ -33,13 +33,15 @@ def get_user_state(user_id: str) -> Dict[str, Any]:
     Returns:
         Словарь с состоянием: {"state": "...", "data": {...}}
     """
-    if user_id not in user_states:
-        user_states[user_id] = {
+    user_state = user_states.get(user_id)
+    if user_state is None:
+        # setdefault атомарен: два потока webhook'а с сообщениями одного
+        # пользователя не создадут две разные записи (одна бы потерялась)
+        user_state = user_states.setdefault(user_id, {
             "state": None,
             "data": {}
-        }
-    
-    return user_states[user_id]
+        })
+    return user_state
 
 
 def set_user_state(user_id: str, state: Optional[str], data: Optional[Dict] = None):
@@ -51,18 +53,13 @@ def set_user_state(user_id: str, state: Optional[str], data: Optional[Dict] = No
         state: Название состояния (например, "waiting_name")
         data: Дополнительные данные состояния
     """
-    if user_id not in user_states:
-        user_states[user_id] = {
-            "state": None,
-            "data": {}
-        }
-    
-    user_states[user_id]["state"] = state
+    user_state = get_user_state(user_id)
+    user_state["state"] = state
     
     if data is not None:
-        user_states[user_id]["data"] = data
+        user_state["data"] = data
     
-    logger.debug(f"🔄 Состояние {user_id}: {state}")
+    logger.debug("🔄 Состояние %s: %s", user_id, state)
 
 
 def update_user_data(user_id: str, key: str, value: Any):
@@ -76,7 +73,7 @@ def update_user_data(user_id: str, key: str, value: Any):
     """
     state = get_user_state(user_id)
     state["data"][key] = value
-    logger.debug(f"📝 Обновлены данные {user_id}: {key} = {value}")
+    logger.debug("📝 Обновлены данные %s: %s = %s", user_id, key, value)
 
 
 def get_user_data(user_id: str, key: str, default: Any = None) -> Any:
@@ -106,7 +103,7 @@ def clear_user_state(user_id: str):
         "state": None,
         "data": {}
     }
-    logger.debug(f"🧹 Состояние {user_id} очищено")
+    logger.debug("🧹 Состояние %s очищено", user_id)
 
 
 def delete_user_state(user_id: str):
@@ -116,9 +113,8 @@ def delete_user_state(user_id: str):
     Args:
         user_id: ID пользователя
     """
-    if user_id in user_states:
-        del user_states[user_id]
-        logger.debug(f"🗑️ Состояние {user_id} удалено")
+    if user_states.pop(user_id, None) is not None:
+        logger.debug("🗑️ Состояние %s удалено", user_id)
 
 
 def get_all_states() -> Dict[str, Dict[str, Any]]:
@@ -4,16 +4,48 @@
 Поддержка FSM (машины состояний).
 """
 import logging
-from flask import Blueprint, request, jsonify
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import orjson
+from flask import Blueprint, Response, request, jsonify
 from config import VERIFY_TOKEN
 from menu_handlers import handle_incoming_message
-from utils.state import get_state, States
 
 logger = logging.getLogger(__name__)
 
 # Создаём Blueprint для webhook
 webhook_bp = Blueprint('webhook', __name__)
 
+# Фоновая обработка сообщений: webhook отвечает 200 сразу,
+# не дожидаясь исходящих запросов к 360dialog.
+# Однопоточные исполнители выбираются по хешу номера отправителя: сообщения
+# одного пользователя (в том числе из разных webhook'ов) идут строго по
+# порядку поступления, разные пользователи - параллельно
+_SENDER_EXECUTORS = 32
+_executors = tuple(
+    ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"webhook-{i}")
+    for i in range(_SENDER_EXECUTORS)
+)
+
+# 360dialog повторяет доставку webhook, если не дождался ответа вовремя.
+# ID уже принятых сообщений помним MESSAGE_DEDUP_TTL секунд, чтобы
+# не обработать сообщение (и не ответить пользователю) дважды
+MESSAGE_DEDUP_TTL = 300
+_seen_message_ids: dict = {}
+_seen_lock = threading.Lock()
+
+# Подтверждение приёма webhook одинаковое для каждого POST - готовые байты.
+# Response создаётся на каждый запрос: Flask дописывает в него заголовки,
+# общий объект между потоками делить нельзя
+_OK_BODY = orjson.dumps({"status": "ok"})
+
+# Ответ healthcheck не меняется - сериализуем один раз при импорте
+_HEALTH_BODY = orjson.dumps({
+    "status": "healthy",
+    "service": "WhatsApp Bot 360dialog"
+})
+
 
 @webhook_bp.route('/webhook', methods=['GET'])
 def webhook_verify():
@@ -29,7 +61,7 @@ def webhook_verify():
     token = request.args.get('hub.verify_token')
     challenge = request.args.get('hub.challenge')
     
-    logger.info(f"📥 Получен запрос верификации webhook: mode={mode}, token={'***' if token else None}")
+    logger.info("📥 Получен запрос верификации webhook: mode=%s, token=%s", mode, '***' if token else None)
     
     # Проверяем токен
     if mode == 'subscribe' and token == VERIFY_TOKEN:
@@ -62,13 +94,20 @@ def webhook_receive():
     }
     """
     try:
-        data = request.get_json()
+        # orjson вместо stdlib json: тело webhook парсится в разы быстрее.
+        # cache=False: тело читается один раз, копию в request не храним
+        try:
+            data = orjson.loads(request.get_data(cache=False))
+        except orjson.JSONDecodeError:
+            data = None
         
         if not data:
             logger.warning("[WARN] Получен пустой webhook запрос")
             return jsonify({"status": "error", "message": "No data"}), 400
         
-        logger.info(f"[WEBHOOK] Получен webhook: {data}")
+        # Полный payload - только на DEBUG: сериализация всего тела дорогая
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[WEBHOOK] Получен webhook: %s", orjson.dumps(data).decode())
         
         # Обработка сообщений
         # 360dialog присылает данные в формате: entry[0].changes[0].value.messages
@@ -84,98 +123,116 @@ def webhook_receive():
         if not messages:
             messages = data.get('messages', [])
         
-        for message in messages:
-            try:
-                phone = message.get('from')
-                msg_type = message.get('type')
-                
-                # Получаем текущее состояние FSM пользователя
-                user_state = get_state(phone)
-                current_state = user_state.get('state')
-                
-                logger.info(f"[MSG] От {phone}, тип: {msg_type}, состояние FSM: {current_state}")
-                
-                if msg_type == 'text':
-                    # Текстовое сообщение
-                    text_body = message.get('text', {}).get('body', '').strip()
-                    logger.info(f"[TEXT] {phone}: {text_body}")
-                    
-                    # FSM: Обработка в зависимости от состояния
-                    if current_state == States.SELECT_WORK:
-                        logger.info(f"[FSM] Состояние SELECT_WORK - обработка текста")
-                    elif current_state == States.SELECT_SHIFT:
-                        logger.info(f"[FSM] Состояние SELECT_SHIFT - обработка текста")
-                    elif current_state == States.SELECT_HOURS:
-                        logger.info(f"[FSM] Состояние SELECT_HOURS - обработка текста")
-                    elif current_state == States.CONFIRM_SAVE:
-                        logger.info(f"[FSM] Состояние CONFIRM_SAVE - обработка текста")
-                    
-                    handle_incoming_message(message)
-                
-                elif msg_type == 'interactive':
-                    # Интерактивное сообщение (кнопка или список)
-                    interactive = message.get('interactive', {})
-                    interactive_type = interactive.get('type')
-                    
-                    if interactive_type == 'button_reply':
-                        # Ответ на кнопку
-                        button_reply = interactive.get('button_reply', {})
-                        button_id = button_reply.get('id', '')
-                        button_title = button_reply.get('title', '')
-                        logger.info(f"[BUTTON] {phone}: {button_id} ({button_title})")
-                        
-                        # FSM: Обработка кнопок в зависимости от состояния
-                        if current_state == States.CONFIRM_SAVE:
-                            logger.info(f"[FSM] Состояние CONFIRM_SAVE - обработка кнопки подтверждения")
-                        
-                        # Добавляем button_id в message для обработки
-                        message['button_id'] = button_id
-                        handle_incoming_message(message)
-                    
-                    elif interactive_type == 'list_reply':
-                        # Ответ на список
-                        list_reply = interactive.get('list_reply', {})
-                        list_id = list_reply.get('id', '')
-                        list_title = list_reply.get('title', '')
-                        logger.info(f"[LIST] {phone}: {list_id} ({list_title})")
-                        
-                        # FSM: Обработка списков в зависимости от состояния
-                        if current_state == States.SELECT_WORK:
-                            logger.info(f"[FSM] Состояние SELECT_WORK - обработка выбора работы")
-                        elif current_state == States.SELECT_SHIFT:
-                            logger.info(f"[FSM] Состояние SELECT_SHIFT - обработка выбора смены")
-                        elif current_state == States.SELECT_HOURS:
-                            logger.info(f"[FSM] Состояние SELECT_HOURS - обработка выбора часов")
-                        
-                        # Добавляем list_id в message для обработки
-                        message['list_id'] = list_id
-                        handle_incoming_message(message)
-                
-                else:
-                    logger.warning(f"[WARN] Неподдерживаемый тип сообщения: {msg_type}")
-                    
-            except Exception as e:
-                logger.error(f"[ERROR] Ошибка обработки сообщения: {e}", exc_info=True)
+        # Повторные доставки уже принятых сообщений отбрасываем
+        messages = [m for m in messages if not is_duplicate_message(m.get('id'))]
+        
+        # Отвечаем 360dialog сразу, сообщения обрабатываются в фоне:
+        # разные отправители - параллельно, сообщения одного - по порядку
+        for sender_messages in group_by_sender(messages):
+            executor = _executors[hash(sender_messages[0].get('from')) % _SENDER_EXECUTORS]
+            executor.submit(process_messages, sender_messages)
         
         # Обработка статусов доставки (опционально)
         statuses = data.get('statuses', [])
         if statuses:
-            logger.debug(f"[STATUS] Получены статусы: {statuses}")
+            logger.debug("[STATUS] Получены статусы: %s", statuses)
         
-        return jsonify({"status": "ok"}), 200
+        return Response(_OK_BODY, status=200, mimetype="application/json")
         
     except Exception as e:
-        logger.error(f"[ERROR] Ошибка в webhook_receive: {e}", exc_info=True)
+        logger.error("[ERROR] Ошибка в webhook_receive: %s", e, exc_info=True)
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
+def is_duplicate_message(message_id: str) -> bool:
+    """
+    Проверяет, принималось ли сообщение с таким ID недавно, и запоминает его.
+    
+    Args:
+        message_id: ID сообщения из webhook (messages[].id)
+    
+    Returns:
+        bool: True если сообщение уже было принято (повторная доставка)
+    """
+    if not message_id:
+        return False
+    
+    now = time.monotonic()
+    with _seen_lock:
+        # dict хранит порядок вставки, он же порядок времени приёма:
+        # устаревшие записи всегда в начале
+        expired = []
+        for old_id, seen_at in _seen_message_ids.items():
+            if now - seen_at < MESSAGE_DEDUP_TTL:
+                break
+            expired.append(old_id)
+        for old_id in expired:
+            del _seen_message_ids[old_id]
+        
+        if message_id in _seen_message_ids:
+            logger.info("[DUP] Повторная доставка сообщения %s, пропускаем", message_id)
+            return True
+        
+        _seen_message_ids[message_id] = now
+        return False
+
+
+def group_by_sender(messages: list) -> list:
+    """
+    Группирует сообщения из webhook по отправителю.
+    
+    Порядок сообщений внутри группы сохраняется.
+    
+    Args:
+        messages: Список сообщений из webhook
+    
+    Returns:
+        list: Списки сообщений, по одному на отправителя
+    """
+    if len(messages) == 1:
+        return [messages]
+    
+    groups = {}
+    for message in messages:
+        groups.setdefault(message.get('from'), []).append(message)
+    return list(groups.values())
+
+
+def process_messages(messages: list):
+    """
+    Обрабатывает сообщения одного отправителя (в фоновом потоке).
+    
+    Сообщения обрабатываются по порядку в исполнителе отправителя,
+    чтобы переходы FSM пользователя не перемешивались, даже если следующее
+    его сообщение пришло отдельным webhook'ом.
+    
+    Args:
+        messages: Список сообщений из webhook (все от одного отправителя)
+    """
+    for message in messages:
+        process_message(message)
+
+
+def process_message(message: dict):
+    """
+    Обрабатывает одно входящее сообщение.
+    
+    Разбор сообщения и маршрутизация - в menu_handlers.handle_incoming_message().
+    Ошибки логируются здесь: в фоновом потоке их больше некому перехватить.
+    
+    Args:
+        message: Сообщение из webhook 360dialog
+    """
+    try:
+        handle_incoming_message(message)
+    except Exception as e:
+        logger.error("[ERROR] Ошибка обработки сообщения: %s", e, exc_info=True)
+
+
 @webhook_bp.route('/health', methods=['GET'])
 def health_check():
     """
     GET /health - проверка работоспособности сервера.
     """
-    return jsonify({
-        "status": "healthy",
-        "service": "WhatsApp Bot 360dialog"
-    }), 200
+    return Response(_HEALTH_BODY, status=200, mimetype="application/json")
 